@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""
+    Copyright © 2020 Mia Herkt
+    Licensed under the EUPL, Version 1.2 or - as soon as approved
+    by the European Commission - subsequent versions of the EUPL
+    (the "License");
+    You may not use this work except in compliance with the License.
+    You may obtain a copy of the license at:
+
+        https://joinup.ec.europa.eu/software/page/eupl
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+    either express or implied.
+    See the License for the specific language governing permissions
+    and limitations under the License.
+"""
+
+import ipaddress
+import os
+import threading
+from bisect import bisect_right
+from pathlib import Path
+
+"""
+Parses an address, treating IPv4-mapped IPv6 addresses as the IPv4 address
+they represent.
+"""
+def parse_address(addr: str):
+    ip = ipaddress.ip_address(addr)
+
+    if ip.version == 6 and ip.ipv4_mapped:
+        return ip.ipv4_mapped
+
+    return ip
+
+class IPBlocklist:
+    """
+    A file of IP addresses and CIDR ranges, one per line, with comment lines
+    starting with a pound sign (#).
+
+    Entries are compiled into sorted, non-overlapping ranges per address
+    family, which are searched with bisection.  IPv6 entries more specific
+    than v6_prefix bits are widened to that prefix, since a single host
+    usually has a whole /64 at its disposal.
+
+    The file is checked for changes on every lookup.  If it only grew, just
+    the appended lines are parsed, so adding entries with add() is cheap for
+    every process using the same file.  Any other change causes a full
+    rebuild.  An unterminated last line is used, but parsed again once it
+    grows, as it might not have been written completely.
+    """
+    _TAIL = 256
+    _empty = { 4 : ([], []), 6 : ([], []) }
+
+    def __init__(self, path, v6_prefix=64):
+        self.path = Path(path)
+        self.v6_prefix = v6_prefix
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._ranges = self._empty
+        self._base = self._empty
+        self._stat = None
+        self._offset = 0
+        self._tail = b""
+
+    def _network(self, entry: str):
+        net = ipaddress.ip_network(entry, strict=False)
+
+        if net.version == 6:
+            if net.network_address.ipv4_mapped:
+                mapped = net.network_address.ipv4_mapped
+                return ipaddress.ip_network(f"{mapped}/{max(net.prefixlen - 96, 0)}", strict=False)
+
+            if self.v6_prefix is not None and net.prefixlen > self.v6_prefix:
+                return net.supernet(new_prefix=self.v6_prefix)
+
+        return net
+
+    def _parse(self, data: bytes):
+        nets = []
+
+        for line in data.decode("utf-8", "replace").splitlines():
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            try:
+                nets.append(self._network(line))
+            except ValueError:
+                pass
+
+        return nets
+
+    def _merge(self, base, nets):
+        if not nets:
+            return base
+
+        ranges = {}
+
+        for v, (starts, ends) in base.items():
+            new = sorted([(int(n.network_address), int(n.broadcast_address))
+                          for n in nets if n.version == v] + list(zip(starts, ends)))
+            merged = []
+
+            for s, e in new:
+                if merged and s <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], e)
+                else:
+                    merged.append([s, e])
+
+            ranges[v] = ([s for s, e in merged], [e for s, e in merged])
+
+        return ranges
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            if self._stat is not None:
+                self._reset()
+            return
+
+        if (st.st_ino, st.st_size, st.st_mtime_ns) == self._stat:
+            return
+
+        with self._lock, open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+
+            start = 0
+
+            if self._stat and st.st_ino == self._stat[0] and st.st_size > self._offset:
+                # Make sure the part we already know hasn't changed
+                f.seek(self._offset - len(self._tail))
+                if f.read(len(self._tail)) == self._tail:
+                    start = self._offset
+                else:
+                    f.seek(0)
+
+            data = f.read()
+
+            # Only complete lines are kept as the base for the next time
+            end = data.rfind(b"\n") + 1
+            data, partial = data[:end], data[end:]
+
+            base = self._merge(self._base if start else self._empty, self._parse(data))
+
+            # Lookups don't take the lock, so replace everything at once
+            self._ranges = self._merge(base, self._parse(partial))
+            self._base = base
+            self._stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+            self._offset = start + end
+            self._tail = ((self._tail if start else b"") + data)[-self._TAIL:]
+
+    def __contains__(self, addr: str) -> bool:
+        self._refresh()
+
+        try:
+            ip = parse_address(addr)
+        except ValueError:
+            return False
+
+        starts, ends = self._ranges[ip.version]
+        i = bisect_right(starts, int(ip)) - 1
+
+        return i >= 0 and int(ip) <= ends[i]
+
+    def add(self, entry: str):
+        """
+        Appends an address or range to the file.
+        """
+        try:
+            entry = parse_address(entry)
+        except ValueError:
+            entry = self._network(entry)
+
+        with open(self.path, "a+b") as f:
+            # Don't join the entry to an unterminated last line
+            sep = b""
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    sep = b"\n"
+
+            f.write(sep + f"{entry}\n".encode())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""
+    Copyright © 2020 Mia Herkt
+    Licensed under the EUPL, Version 1.2 or - as soon as approved
+    by the European Commission - subsequent versions of the EUPL
+    (the "License");
+    You may not use this work except in compliance with the License.
+    You may obtain a copy of the license at:
+
+        https://joinup.ec.europa.eu/software/page/eupl
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+    either express or implied.
+    See the License for the specific language governing permissions
+    and limitations under the License.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+class LRUCache:
+    """
+    A mapping of at most size entries, which expire after ttl seconds.  When
+    full, the least recently used entry is evicted.  A size of 0 disables the
+    cache.
+
+    If shared is the name of a uWSGI cache and we are running under uWSGI,
+    entries are stored there instead, so all workers see the same entries.
+
+    Hits and misses are counted in the hits and misses attributes, and also
+    published as the uWSGI metrics <name>.hits and <name>.misses if
+    available.
+    """
+    def __init__(self, name, size, ttl, shared=None):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.shared = shared if uwsgi else None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _count(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        if uwsgi:
+            try:
+                uwsgi.metric_inc(f"{self.name}.{'hits' if hit else 'misses'}")
+            except:
+                pass
+
+    def get(self, key, default=None):
+        if not self.size:
+            return default
+
+        if self.shared:
+            value = uwsgi.cache_get(f"{self.name}:{key}", self.shared)
+            self._count(value is not None)
+            return default if value is None else pickle.loads(value)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._count(True)
+                return entry[1]
+
+            if entry:
+                del self._entries[key]
+
+        self._count(False)
+        return default
+
+    def set(self, key, value):
+        if not self.size:
+            return
+
+        if self.shared:
+            uwsgi.cache_update(f"{self.name}:{key}", pickle.dumps(value), int(self.ttl), self.shared)
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        if self.shared:
+            uwsgi.cache_del(f"{self.name}:{key}", self.shared)
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        if self.shared:
+            uwsgi.cache_clear(self.shared)
+            return
+
+        with self._lock:
+            self._entries.clear()
@@ -19,25 +19,41 @@
     and limitations under the License.
 """
 
-from flask import Flask, abort, make_response, redirect, request, send_from_directory, url_for, Response, render_template
+from flask import Flask, abort, g, make_response, redirect, request, url_for, Response, render_template
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 from jinja2.exceptions import *
 from jinja2 import ChoiceLoader, FileSystemLoader
+from markupsafe import escape
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.wsgi import wrap_file
 from hashlib import sha256
 from magic import Magic
 from mimetypes import guess_extension
+from contextlib import contextmanager
 import click
+import fcntl
 import os
 import sys
 import time
 import datetime
 import typing
 import requests
+import re
 import secrets
+import shutil
+import socket
+import tempfile
+import threading
 from validators import url as url_valid
 from pathlib import Path
+from storage import LocalStorage, TieredStorage, is_digest, open_object, compress
+from cache import LRUCache
+from blocklist import IPBlocklist
+from ratelimit import RateLimiter, client_key
+from hashstate import SHA256State
 
 app = Flask(__name__, instance_relative_config=True)
 app.config.update(
@@ -48,8 +64,27 @@ app.config.update(
     USE_X_SENDFILE = False,
     FHOST_USE_X_ACCEL_REDIRECT = True, # expect nginx by default
     FHOST_STORAGE_PATH = "up",
+    FHOST_STORAGE_SHARD_DEPTH = 0,
+    FHOST_STORAGE_BACKEND = "local",
+    FHOST_STORAGE_COLD_PATH = None,
+    FHOST_TIER_COLD_AFTER = datetime.timedelta(days=7),
+    FHOST_TIER_HOT_WITHIN = datetime.timedelta(days=1),
+    FHOST_TIER_MIN_SIZE = 1024 * 1024,
+    FHOST_TIER_TOUCH_INTERVAL = 3600,
     FHOST_MAX_EXT_LENGTH = 9,
     FHOST_SECRET_BYTES = 16,
+    FHOST_CHUNK_SIZE = 64 * 1024,
+    FHOST_MAX_RANGES = 16,
+    FHOST_COMPRESSION = None,
+    FHOST_COMPRESS_MIME = [
+        "application/json",
+        "application/xml",
+        "image/svg+xml",
+        "text/csv",
+        "text/html",
+        "text/plain",
+        "text/x-diff",
+    ],
     FHOST_EXT_OVERRIDE = {
         "audio/flac" : ".flac",
         "image/gif" : ".gif",
@@ -69,8 +104,38 @@ app.config.update(
         "application/java-vm"
     ],
     FHOST_UPLOAD_BLACKLIST = None,
+    FHOST_UPLOAD_BLACKLIST_V6_PREFIX = 64,
+    FHOST_RATELIMIT_PATH = None,
+    FHOST_RATELIMIT_V6_PREFIX = 64,
+    FHOST_UPLOAD_RATE = None,
+    FHOST_UPLOAD_BURST = 30,
+    FHOST_UPLOAD_BYTE_RATE = None,
+    FHOST_UPLOAD_BYTE_BURST = 1024 * 1024 * 1024,
+    FHOST_UPLOAD_INFLIGHT_BYTES = None,
+    FHOST_FETCH_CONCURRENCY = 8,
+    FHOST_FETCH_CONNECT_TIMEOUT = 10,
+    FHOST_FETCH_READ_TIMEOUT = 30,
+    FHOST_FETCH_DEADLINE = 600,
+    FHOST_FETCH_LOCK_PATH = None,
+    FHOST_CACHE_CONTROL = "public, max-age={max_age}, immutable",
+    FHOST_CACHE_CONTROL_SECRET = "private, max-age={max_age}, immutable",
+    FHOST_CACHE_CONTROL_NSFW = "public, max-age={max_age}, immutable",
     NSFW_DETECT = False,
     NSFW_THRESHOLD = 0.608,
+    NSFW_ASYNC = False,
+    NSFW_SOCKET = None,
+    NSFW_VIDEO_SAMPLES = 1,
+    NSFW_VIDEO_AGGREGATE = "max",
+    NSFW_BATCH_SIZE = 16,
+    NSFW_BATCH_WAIT = 0.01,
+    NSFW_WORKERS = None,
+    NSFW_RETRIES = 3,
+    NSFW_RETRY_DELAY = 60,
+    NSFW_POLL_INTERVAL = 5,
+    FHOST_PRUNE_HORIZON = datetime.timedelta(hours=1),
+    FHOST_PRUNE_POLL_INTERVAL = 10,
+    FHOST_PRUNE_DAEMON = False,
+    FHOST_RESUMABLE_TTL = datetime.timedelta(days=1),
     VSCAN_SOCKET = None,
     VSCAN_QUARANTINE_PATH = "quarantine",
     VSCAN_IGNORE = [
@@ -78,6 +143,25 @@ app.config.update(
         "PUA.Win.Packer.XmMusicFile",
     ],
     VSCAN_INTERVAL = datetime.timedelta(days=7),
+    VSCAN_MODE = "instream",
+    VSCAN_RISKY_MIME = [
+        "application/",
+        "image/svg+xml",
+        "text/html",
+        "text/javascript",
+        "text/x-",
+    ],
+    FHOST_META_CACHE_SIZE = 10000,
+    FHOST_META_CACHE_TTL = 60,
+    FHOST_META_CACHE_SHARED = None,
+    FHOST_META_CACHE_POLL_INTERVAL = 1,
+    FHOST_MISS_CACHE_SIZE = 10000,
+    FHOST_MISS_CACHE_TTL = 3600,
+    FHOST_MAX_ID_REFRESH = 1,
+    FHOST_MISS_CACHE_WINDOW = 100,
+    FHOST_REDIRECT_CACHE_SIZE = 10000,
+    FHOST_REDIRECT_CACHE_TTL = 3600,
+    FHOST_REDIRECT_CACHE_CONTROL = None,
     URL_ALPHABET = "DEQhd2uFteibPwq0SWBInTpA_jcZL5GKz3YCR14Ulk87Jors9vNHgfaOmMXy6Vx-",
 )
 
@@ -91,9 +175,11 @@ if not app.config["TESTING"]:
     if app.config["DEBUG"]:
         app.config["FHOST_USE_X_ACCEL_REDIRECT"] = False
 
-if app.config["NSFW_DETECT"]:
+if app.config["NSFW_DETECT"] and not app.config["NSFW_ASYNC"]:
     from nsfw_detect import NSFWDetector
-    nsfw = NSFWDetector()
+    nsfw = NSFWDetector(app.config["NSFW_SOCKET"],
+                        app.config["NSFW_VIDEO_SAMPLES"],
+                        app.config["NSFW_VIDEO_AGGREGATE"])
 
 try:
     mimedetect = Magic(mime=True, mime_encoding=False)
@@ -108,10 +194,12 @@ migrate = Migrate(app, db)
 class URL(db.Model):
     __tablename__ = "URL"
     id = db.Column(db.Integer, primary_key = True)
-    url = db.Column(db.UnicodeText, unique = True)
+    url = db.Column(db.UnicodeText)
+    url_hash = db.Column(db.String(64), index = True, unique = True)
 
     def __init__(self, url):
         self.url = url
+        self.url_hash = URL.hash(url)
 
     def getname(self):
         return su.enbase(self.id)
@@ -119,13 +207,25 @@ class URL(db.Model):
     def geturl(self):
         return url_for("get", path=self.getname(), _external=True) + "\n"
 
+    def hash(url):
+        return sha256(url.encode("utf-8")).hexdigest()
+
     def get(url):
-        u = URL.query.filter_by(url=url).first()
+        h = URL.hash(url)
+        u = URL.query.filter_by(url_hash=h).first()
 
         if not u:
             u = URL(url)
             db.session.add(u)
-            db.session.commit()
+
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Somebody else shortened the same URL at the same time
+                db.session.rollback()
+                u = URL.query.filter_by(url_hash=h).one()
+            else:
+                saw_id(URL, u.id)
 
         return u
 
@@ -138,11 +238,13 @@ class File(db.Model):
     ua = db.Column(db.UnicodeText)
     removed = db.Column(db.Boolean, default=False)
     nsfw_score = db.Column(db.Float)
-    expiration = db.Column(db.BigInteger)
+    expiration = db.Column(db.BigInteger, index = True)
     mgmt_token = db.Column(db.String)
     secret = db.Column(db.String)
     last_vscan = db.Column(db.DateTime)
+    vscan_signatures = db.Column(db.Integer)
     size = db.Column(db.BigInteger)
+    compression = db.Column(db.String)
 
     def __init__(self, sha256, ext, mime, addr, ua, expiration, mgmt_token):
         self.sha256 = sha256
@@ -169,13 +271,37 @@ class File(db.Model):
             return url_for("get", path=n, secret=self.secret, _external=True) + "\n"
 
     def getpath(self) -> Path:
-        return Path(app.config["FHOST_STORAGE_PATH"]) / self.sha256
+        return get_storage().path(self.sha256)
+
+    def open(self):
+        return open_object(self.getpath(), self.compression)
+
+    """
+    Lets a running prune daemon know about the file if it expires within
+    FHOST_PRUNE_HORIZON, as it only looks that far ahead on its own.  Returns
+    True if a notification was added to the session.
+
+    Nothing is done unless FHOST_PRUNE_DAEMON is set, as only the daemon
+    consumes these notifications.
+    """
+    def notify_expiry(self) -> bool:
+        if not app.config["FHOST_PRUNE_DAEMON"]:
+            return False
+
+        horizon = time.time() + app.config["FHOST_PRUNE_HORIZON"].total_seconds()
+
+        if self.expiration is not None and self.expiration < horizon * 1000:
+            db.session.add(ExpiryEvent(self.id))
+            return True
+
+        return False
 
     def delete(self, permanent=False):
         self.expiration = None
         self.mgmt_token = None
         self.removed = permanent
-        self.getpath().unlink(missing_ok=True)
+        get_storage().delete(self.sha256)
+        invalidate_meta([self.id])
 
     # Returns the epoch millisecond that a file should expire
     #
@@ -205,6 +331,70 @@ class File(db.Model):
             # Treat the requested expiration time as a timestamp in epoch millis
             return min(this_files_max_expiration, requested_expiration)
 
+    """
+    Updates an existing file that is being uploaded again.  Returns whether it
+    counts as a new upload, which is the case if it had already expired.
+    """
+    def renew(self, expiration, addr, ua, secret: bool) -> bool:
+        if self.removed:
+            # The file was removed by moderation, so don't accept it back
+            abort(451)
+
+        isnew = self.expiration is None
+
+        if isnew:
+            # The file has expired, so give it a new expiration date
+            self.expiration = expiration
+
+            # Also generate a new management token
+            self.mgmt_token = secrets.token_urlsafe()
+
+            self.secret = None
+            if secret:
+                self.secret = secrets.token_urlsafe(app.config["FHOST_SECRET_BYTES"])
+        else:
+            # The file already exists, update the expiration if needed
+            self.expiration = max(self.expiration, expiration)
+
+        self.addr = addr
+        self.ua = ua
+
+        return isnew
+
+    """
+    Renews a file that is offered by its SHA-256 digest and size instead of
+    its contents, like store() would if it had been uploaded.
+
+    Returns None if the contents are needed, because no such file is stored
+    or because it has a secret URL that must not be given out for just a
+    digest.
+    """
+    def store_hash(digest: str, size: int, requested_expiration: typing.Optional[int], addr, ua, secret: bool):
+        storage = get_storage()
+        storage.tmpdir.mkdir(parents=True, exist_ok=True)
+
+        with digest_lock(storage.tmpdir, digest):
+            f = File.query.filter_by(sha256=digest).first()
+
+            if not f:
+                return None
+
+            if not f.removed:
+                if f.size != size or not storage.exists(digest):
+                    return None
+                if f.secret and f.expiration is not None:
+                    return None
+
+            isnew = f.renew(File.get_expiration(requested_expiration, size), addr, ua, secret)
+            db.session.commit()
+
+        meta_cache.invalidate(f.id)
+
+        if f.notify_expiry():
+            db.session.commit()
+
+        return f, isnew
+
     """
     requested_expiration can be:
         - None, to use the longest allowed file lifespan
@@ -215,97 +405,444 @@ class File(db.Model):
     value.
     """
     def store(file_, requested_expiration: typing.Optional[int], addr, ua, secret: bool):
-        data = file_.read()
-        digest = sha256(data).hexdigest()
+        storage = get_storage()
+        storage.tmpdir.mkdir(parents=True, exist_ok=True)
 
-        def get_mime():
-            guess = mimedetect.from_buffer(data)
-            app.logger.debug(f"MIME - specified: '{file_.content_type}' - detected: '{guess}'")
+        tmp, digest, size = spool(file_, storage.tmpdir)
 
-            if not file_.content_type or not "/" in file_.content_type or file_.content_type == "application/octet-stream":
-                mime = guess
-            else:
-                mime = file_.content_type
+        return File.store_spooled(tmp, digest, size, file_.filename, file_.content_type,
+                                  requested_expiration, addr, ua, secret)
 
-            if mime in app.config["FHOST_MIME_BLACKLIST"] or guess in app.config["FHOST_MIME_BLACKLIST"]:
-                abort(415)
+    """
+    Like store(), for an upload that has already been written to tmp in the
+    storage directory, with the given digest and size.  Either moves tmp into
+    storage or removes it.
+    """
+    def store_spooled(tmp: Path, digest: str, size: int, filename, content_type,
+                      requested_expiration: typing.Optional[int], addr, ua, secret: bool):
+        storage = get_storage()
 
-            if len(mime) > 128:
-                abort(400)
+        try:
+            def get_mime():
+                guess = mimedetect.from_file(str(tmp))
+                app.logger.debug(f"MIME - specified: '{content_type}' - detected: '{guess}'")
+
+                if not content_type or not "/" in content_type or content_type == "application/octet-stream":
+                    mime = guess
+                else:
+                    mime = content_type
+
+                if mime in app.config["FHOST_MIME_BLACKLIST"] or guess in app.config["FHOST_MIME_BLACKLIST"]:
+                    abort(415)
+
+                if len(mime) > 128:
+                    abort(400)
+
+                if mime.startswith("text/") and not "charset" in mime:
+                    mime += "; charset=utf-8"
+
+                return mime
+
+            def get_ext(mime):
+                ext = "".join(Path(filename).suffixes[-2:])
+                if len(ext) > app.config["FHOST_MAX_EXT_LENGTH"]:
+                    ext = Path(filename).suffixes[-1]
+                gmime = mime.split(";")[0]
+                guess = guess_extension(gmime)
+
+                app.logger.debug(f"extension - specified: '{ext}' - detected: '{guess}'")
+
+                if not ext:
+                    if gmime in app.config["FHOST_EXT_OVERRIDE"]:
+                        ext = app.config["FHOST_EXT_OVERRIDE"][gmime]
+                    elif guess:
+                        ext = guess
+                    else:
+                        ext = ""
+
+                return ext[:app.config["FHOST_MAX_EXT_LENGTH"]] or ".bin"
+
+            # Uploads of the same file wait for each other, so only the first
+            # one stores it and the others update its row
+            with digest_lock(storage.tmpdir, digest):
+                for attempt in range(2):
+                    expiration = File.get_expiration(requested_expiration, size)
+
+                    f = File.query.filter_by(sha256=digest).first()
+                    if f:
+                        # If the file already exists
+                        isnew = f.renew(expiration, addr, ua, secret)
+                    else:
+                        mime = get_mime()
+                        ext = get_ext(mime)
+                        mgmt_token = secrets.token_urlsafe()
+                        f = File(digest, ext, mime, addr, ua, expiration, mgmt_token)
+                        isnew = True
+
+                        f.secret = None
+                        if secret:
+                            f.secret = secrets.token_urlsafe(app.config["FHOST_SECRET_BYTES"])
+
+                    if not storage.exists(digest):
+                        f.compression = None
+
+                        if app.config["FHOST_COMPRESSION"] and f.mime.split(";")[0] in app.config["FHOST_COMPRESS_MIME"]:
+                            ctmp = compress_spooled(tmp, storage.tmpdir)
+
+                            # Only keep the compressed copy if it's actually smaller
+                            if ctmp.stat().st_size < size:
+                                tmp.unlink()
+                                tmp = ctmp
+                                f.compression = app.config["FHOST_COMPRESSION"]
+                            else:
+                                ctmp.unlink()
+
+                    p = storage.put(tmp, digest)
+
+                    f.size = size
+
+                    if not f.nsfw_score and app.config["NSFW_DETECT"] and not app.config["NSFW_ASYNC"]:
+                        f.nsfw_score = nsfw.detect(str(p))
+
+                    db.session.add(f)
+
+                    try:
+                        db.session.commit()
+                    except IntegrityError:
+                        # Another machine stored the same file first, so update its row
+                        db.session.rollback()
+                        if attempt:
+                            raise
+                        continue
+
+                    break
+        finally:
+            tmp.unlink(missing_ok=True)
+
+        meta_cache.invalidate(f.id)
+        saw_id(File, f.id)
+
+        if f.notify_expiry():
+            db.session.commit()
 
-            if mime.startswith("text/") and not "charset" in mime:
-                mime += "; charset=utf-8"
+        return f, isnew
 
-            return mime
 
-        def get_ext(mime):
-            ext = "".join(Path(file_.filename).suffixes[-2:])
-            if len(ext) > app.config["FHOST_MAX_EXT_LENGTH"]:
-                ext = Path(file_.filename).suffixes[-1]
-            gmime = mime.split(";")[0]
-            guess = guess_extension(gmime)
+"""
+The parts of a file's database record needed to serve it, cached in
+meta_cache to avoid a database query for each download.
+"""
+class FileMeta(typing.NamedTuple):
+    sha256: str
+    ext: str
+    mime: str
+    size: int
+    secret: typing.Optional[str]
+    removed: bool
+    expiration: typing.Optional[int]
+    compression: typing.Optional[str]
+    nsfw_score: typing.Optional[float]
 
-            app.logger.debug(f"extension - specified: '{ext}' - detected: '{guess}'")
+    @property
+    def is_nsfw(self) -> bool:
+        return self.nsfw_score and self.nsfw_score > app.config["NSFW_THRESHOLD"]
 
-            if not ext:
-                if gmime in app.config["FHOST_EXT_OVERRIDE"]:
-                    ext = app.config["FHOST_EXT_OVERRIDE"][gmime]
-                elif guess:
-                    ext = guess
-                else:
-                    ext = ""
+    def getpath(self) -> Path:
+        return get_storage().path(self.sha256)
+
+    def open(self):
+        return open_object(self.getpath(), self.compression)
+
+    def from_file(f):
+        return FileMeta(f.sha256, f.ext, f.mime, f.size, f.secret, f.removed,
+                        f.expiration, f.compression, f.nsfw_score)
+
+meta_cache = LRUCache("fhost.meta_cache",
+                      app.config["FHOST_META_CACHE_SIZE"],
+                      app.config["FHOST_META_CACHE_TTL"],
+                      app.config["FHOST_META_CACHE_SHARED"])
+
+miss_cache = LRUCache("fhost.miss_cache",
+                      app.config["FHOST_MISS_CACHE_SIZE"],
+                      app.config["FHOST_MISS_CACHE_TTL"])
+
+# Shortened URLs never change
+redirect_cache = LRUCache("fhost.redirect_cache",
+                          app.config["FHOST_REDIRECT_CACHE_SIZE"],
+                          app.config["FHOST_REDIRECT_CACHE_TTL"])
+
+# The highest known ID of each table, and when it was last queried
+_max_ids = {}
+
+def saw_id(model, id: int):
+    m, checked = _max_ids.get(model, (0, 0))
+    _max_ids[model] = (max(m, id), checked)
+    miss_cache.invalidate((model, id))
+
+"""
+Returns True if id is higher than that of any row of model, in which case
+there is no point in looking it up.
+
+The highest ID is cached, but rows may have been added by other processes
+since.  So only IDs with more digits than the table could plausibly have
+grown to since the highest ID was last queried, at most
+FHOST_MAX_ID_REFRESH seconds ago, are rejected outright.  For any other ID
+above the cached one, the highest ID is queried again.
+"""
+def beyond_max_id(model, id: int) -> bool:
+    m, checked = _max_ids.get(model, (0, 0))
+
+    if id <= m:
+        return False
+
+    now = time.monotonic()
+    if now - checked < app.config["FHOST_MAX_ID_REFRESH"] and \
+            len(su.enbase(id)) > len(su.enbase(m)) + 1:
+        return True
+
+    m = db.session.query(db.func.max(model.id)).scalar() or 0
+    _max_ids[model] = (m, now)
+
+    return id > m
+
+"""
+Remembers that id doesn't exist, unless it is within FHOST_MISS_CACHE_WINDOW
+of the highest ID.  Those might belong to inserts that haven't been
+committed yet, as IDs from sequences are handed out before the commit.
+"""
+def remember_miss(model, id: int):
+    m, checked = _max_ids.get(model, (0, 0))
+
+    if id + app.config["FHOST_MISS_CACHE_WINDOW"] <= m:
+        miss_cache.set((model, id), True)
+
+"""
+Drops the cached metadata of the given files in this process, and adds them
+to the cache_invalidation table so all other processes do the same.  The
+caller has to commit the session.
+"""
+def invalidate_meta(ids: typing.List[int]):
+    if not app.config["FHOST_META_CACHE_SIZE"] or not ids:
+        return
+
+    for id in ids:
+        meta_cache.invalidate(id)
+
+    db.session.add_all([CacheInvalidation(id) for id in ids])
+
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=app.config["FHOST_META_CACHE_TTL"])
+    CacheInvalidation.query.filter(CacheInvalidation.created < cutoff)\
+        .delete(synchronize_session=False)
+
+# The last invalidation seen by this process, and when to look for more
+_last_invalidation = None
+_next_invalidation_poll = 0
+
+"""
+Drops cached metadata that was invalidated by other processes since the
+last call, at most every FHOST_META_CACHE_POLL_INTERVAL seconds.
+"""
+def poll_invalidations():
+    global _last_invalidation, _next_invalidation_poll
+
+    now = time.monotonic()
+    if now < _next_invalidation_poll:
+        return
 
-            return ext[:app.config["FHOST_MAX_EXT_LENGTH"]] or ".bin"
+    _next_invalidation_poll = now + app.config["FHOST_META_CACHE_POLL_INTERVAL"]
 
-        expiration = File.get_expiration(requested_expiration, len(data))
-        isnew = True
+    if _last_invalidation is None:
+        # Nothing has been cached yet
+        _last_invalidation = db.session.query(db.func.max(CacheInvalidation.id)).scalar() or 0
+        return
+
+    for id, file_id in db.session.query(CacheInvalidation.id, CacheInvalidation.file_id)\
+            .filter(CacheInvalidation.id > _last_invalidation)\
+            .order_by(CacheInvalidation.id):
+        meta_cache.invalidate(file_id)
+        _last_invalidation = id
+
+def get_file_meta(id) -> typing.Optional[FileMeta]:
+    if app.config["FHOST_META_CACHE_SIZE"]:
+        poll_invalidations()
+
+    m = meta_cache.get(id)
+
+    if not m:
+        f = File.query.get(id)
 
-        f = File.query.filter_by(sha256=digest).first()
         if f:
-            # If the file already exists
-            if f.removed:
-                # The file was removed by moderation, so don't accept it back
-                abort(451)
-            if f.expiration is None:
-                # The file has expired, so give it a new expiration date
-                f.expiration = expiration
+            m = FileMeta.from_file(f)
 
-                # Also generate a new management token
-                f.mgmt_token = secrets.token_urlsafe()
-            else:
-                # The file already exists, update the expiration if needed
-                f.expiration = max(f.expiration, expiration)
-                isnew = False
-        else:
-            mime = get_mime()
-            ext = get_ext(mime)
-            mgmt_token = secrets.token_urlsafe()
-            f = File(digest, ext, mime, addr, ua, expiration, mgmt_token)
+            # Expired files can be uploaded again, possibly with a secret
+            # now, and invalidations only reach this worker's cache.  So
+            # only cache records that can't change in that way.
+            if m.expiration is not None and not m.removed:
+                meta_cache.set(id, m)
 
-        f.addr = addr
-        f.ua = ua
+    return m
 
-        if isnew:
-            f.secret = None
-            if secret:
-                f.secret = secrets.token_urlsafe(app.config["FHOST_SECRET_BYTES"])
 
-        storage = Path(app.config["FHOST_STORAGE_PATH"])
-        storage.mkdir(parents=True, exist_ok=True)
-        p = storage / digest
+"""
+Returns the storage backend selected by FHOST_STORAGE_BACKEND.
 
-        if not p.is_file():
-            with open(p, "wb") as of:
-                of.write(data)
+"local" stores everything in FHOST_STORAGE_PATH.  "tiered" uses that as a
+fast tier for new and recently downloaded files, and FHOST_STORAGE_COLD_PATH
+for everything else.
+"""
+def get_storage():
+    local = LocalStorage(app.config["FHOST_STORAGE_PATH"], app.config["FHOST_STORAGE_SHARD_DEPTH"])
 
-        f.size = len(data)
+    if app.config["FHOST_STORAGE_BACKEND"] == "tiered":
+        cold = LocalStorage(app.config["FHOST_STORAGE_COLD_PATH"], app.config["FHOST_STORAGE_SHARD_DEPTH"])
+        return TieredStorage(local, cold, app.config["FHOST_TIER_TOUCH_INTERVAL"])
 
-        if not f.nsfw_score and app.config["NSFW_DETECT"]:
-            f.nsfw_score = nsfw.detect(str(p))
+    return local
 
-        db.session.add(f)
-        db.session.commit()
-        return f, isnew
+# Temporary files are created with mode 0600, but the web server needs to be
+# able to read stored files, so apply the usual umask-derived mode instead.
+_umask = os.umask(0)
+os.umask(_umask)
+
+"""
+Holds an exclusive lock for the given digest, shared by all processes on this
+machine through a lock file in directory, until the context exits.
+"""
+@contextmanager
+def digest_lock(directory: Path, digest: str):
+    path = directory / f".lock-{digest}"
+
+    while True:
+        lf = open(path, "a")
+        fcntl.flock(lf, fcntl.LOCK_EX)
+
+        # The previous holder might have removed the file while we waited
+        try:
+            if os.fstat(lf.fileno()).st_ino == os.stat(path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+
+        lf.close()
+
+    try:
+        yield
+    finally:
+        path.unlink(missing_ok=True)
+        lf.close()
+
+"""
+Read an upload in chunks of FHOST_CHUNK_SIZE bytes into a temporary file in
+the storage directory, hashing it on the way.
+
+Returns the path of the temporary file, the hex SHA-256 digest and the size
+of the data. The caller is responsible for moving or removing the file.
+"""
+def spool(file_, storage: Path) -> typing.Tuple[Path, str, int]:
+    fd, tmp = tempfile.mkstemp(dir=storage, prefix=".upload-")
+    tmp = Path(tmp)
+    h = sha256()
+    size = 0
+
+    try:
+        with os.fdopen(fd, "wb") as of:
+            os.fchmod(of.fileno(), 0o666 & ~_umask)
+
+            while chunk := file_.read(app.config["FHOST_CHUNK_SIZE"]):
+                h.update(chunk)
+                of.write(chunk)
+                size += len(chunk)
+    except:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    return tmp, h.hexdigest(), size
+
+"""
+Compresses a spooled upload with FHOST_COMPRESSION into a new temporary file
+in the storage directory and returns its path.
+"""
+def compress_spooled(src: Path, storage: Path) -> Path:
+    fd, tmp = tempfile.mkstemp(dir=storage, prefix=".upload-")
+    tmp = Path(tmp)
+
+    try:
+        with os.fdopen(fd, "wb") as of, open(src, "rb") as inf:
+            os.fchmod(of.fileno(), 0o666 & ~_umask)
+            compress(inf, of, app.config["FHOST_COMPRESSION"], app.config["FHOST_CHUNK_SIZE"])
+    except:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    return tmp
+
+
+class ExpiryEvent(db.Model):
+    __tablename__ = "expiry_event"
+    id = db.Column(db.Integer, primary_key = True)
+    file_id = db.Column(db.Integer)
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+"""
+A file whose cached metadata has to be dropped by all processes, as it was
+changed by one of them.  Only rows younger than FHOST_META_CACHE_TTL are
+needed, since older cache entries have expired by themselves.
+"""
+class CacheInvalidation(db.Model):
+    __tablename__ = "cache_invalidation"
+    # IDs must not be reused after old rows are deleted
+    __table_args__ = { "sqlite_autoincrement" : True }
+    id = db.Column(db.Integer, primary_key = True)
+    file_id = db.Column(db.Integer)
+    created = db.Column(db.DateTime, index = True)
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.created = datetime.datetime.now()
+
+"""
+A resumable upload in progress.  Its data is appended to a staging file in
+the storage directory, and the SHA-256 state up to offset is kept in
+hash_state so it never has to be hashed again.
+"""
+class UploadSession(db.Model):
+    __tablename__ = "upload_session"
+    token = db.Column(db.String, primary_key = True)
+    size = db.Column(db.BigInteger)
+    offset = db.Column(db.BigInteger)
+    hash_state = db.Column(db.LargeBinary)
+    filename = db.Column(db.UnicodeText)
+    mime = db.Column(db.UnicodeText)
+    expires = db.Column(db.BigInteger)
+    secret = db.Column(db.Boolean)
+    addr = db.Column(db.UnicodeText)
+    ua = db.Column(db.UnicodeText)
+    updated = db.Column(db.DateTime, index = True)
+
+    def __init__(self, size, filename, mime, expires, secret, addr, ua):
+        self.token = secrets.token_urlsafe()
+        self.size = size
+        self.offset = 0
+        self.hash_state = SHA256State().state if SHA256State.available else None
+        self.filename = filename
+        self.mime = mime
+        self.expires = expires
+        self.secret = secret
+        self.addr = addr
+        self.ua = ua
+        self.updated = datetime.datetime.now()
+
+    def getpath(self) -> Path:
+        return get_storage().tmpdir / f".resumable-{self.token}"
+
+    def geturl(self):
+        return url_for("resumable", token=self.token, _external=True) + "\n"
+
+    def delete(self):
+        self.getpath().unlink(missing_ok=True)
+        db.session.delete(self)
 
 
 class UrlEncoder(object):
@@ -330,6 +867,7 @@ class UrlEncoder(object):
         return result
 
 su = UrlEncoder(alphabet=app.config["URL_ALPHABET"], min_length=1)
+url_alphabet = frozenset(app.config["URL_ALPHABET"])
 
 def fhost_url(scheme=None):
     if not scheme:
@@ -351,16 +889,26 @@ def shorten(url):
 
     return u.geturl()
 
-def in_upload_bl(addr):
-    if app.config["FHOST_UPLOAD_BLACKLIST"]:
-        with app.open_instance_resource(app.config["FHOST_UPLOAD_BLACKLIST"], "r") as bl:
-            check = addr.lstrip("::ffff:")
-            for l in bl.readlines():
-                if not l.startswith("#"):
-                    if check == l.rstrip():
-                        return True
+_upload_blocklists = {}
 
-    return False
+"""
+Returns the compiled FHOST_UPLOAD_BLACKLIST, or None if it isn't set.
+"""
+def get_upload_blocklist() -> typing.Optional[IPBlocklist]:
+    if not app.config["FHOST_UPLOAD_BLACKLIST"]:
+        return None
+
+    path = os.path.join(app.instance_path, app.config["FHOST_UPLOAD_BLACKLIST"])
+    key = (path, app.config["FHOST_UPLOAD_BLACKLIST_V6_PREFIX"])
+
+    if key not in _upload_blocklists:
+        _upload_blocklists[key] = IPBlocklist(*key)
+
+    return _upload_blocklists[key]
+
+def in_upload_bl(addr):
+    bl = get_upload_blocklist()
+    return bl is not None and addr in bl
 
 """
 requested_expiration can be:
@@ -376,7 +924,28 @@ def store_file(f, requested_expiration:  typing.Optional[int], addr, ua, secret:
         return "Your host is blocked from uploading files.\n", 451
 
     sf, isnew = File.store(f, requested_expiration, addr, ua, secret)
+    return stored_response(sf, isnew)
 
+"""
+Like store_file, but for a file offered by its SHA-256 digest and size.  If
+it isn't known, the client is asked to upload it with a 404 response.
+"""
+def store_hash(digest: str, size: int, requested_expiration: typing.Optional[int], addr, ua, secret: bool):
+    if in_upload_bl(addr):
+        return "Your host is blocked from uploading files.\n", 451
+
+    digest = digest.lower()
+    if not is_digest(digest) or size < 0:
+        abort(400)
+
+    stored = File.store_hash(digest, size, requested_expiration, addr, ua, secret)
+
+    if not stored:
+        return "Unknown file, please upload it.\n", 404
+
+    return stored_response(*stored)
+
+def stored_response(sf, isnew: bool):
     response = make_response(sf.geturl())
     response.headers["X-Expires"] = sf.expiration
 
@@ -385,32 +954,207 @@ def store_file(f, requested_expiration:  typing.Optional[int], addr, ua, secret:
 
     return response
 
+fetch_session = requests.Session()
+fetch_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=app.config["FHOST_FETCH_CONCURRENCY"]))
+fetch_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=app.config["FHOST_FETCH_CONCURRENCY"]))
+
+"""
+Takes one of FHOST_FETCH_CONCURRENCY slots for fetching remote files, which
+are shared by all processes on this machine through lock files.  Returns the
+open lock file, or None if all slots are taken.
+"""
+def fetch_slot():
+    lockdir = Path(app.config["FHOST_FETCH_LOCK_PATH"] or tempfile.gettempdir())
+
+    for i in range(app.config["FHOST_FETCH_CONCURRENCY"]):
+        lf = open(lockdir / f"0x0-fetch-{i}.lock", "a")
+        try:
+            fcntl.flock(lf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lf
+        except BlockingIOError:
+            lf.close()
+
+    return None
+
+"""
+A file-like wrapper around a streamed remote response that enforces
+MAX_CONTENT_LENGTH and FHOST_FETCH_DEADLINE while it is being read.
+"""
+class RemoteFile:
+    def __init__(self, r):
+        self.content_type = r.headers.get("content-type")
+        self.filename = ""
+        self._r = r
+        self._length = 0
+        self._deadline = time.monotonic() + app.config["FHOST_FETCH_DEADLINE"]
+
+    def read(self, n=-1):
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            abort(504)
+
+        # The read timeout only applies to each packet, so a slow trickle
+        # could otherwise hold a single read open far beyond the deadline
+        sock = getattr(getattr(self._r.raw, "connection", None), "sock", None)
+        if sock:
+            sock.settimeout(min(app.config["FHOST_FETCH_READ_TIMEOUT"], remaining))
+
+        try:
+            # Return whatever has arrived instead of waiting for n bytes
+            chunk = self._r.raw.read1(n)
+        except Exception:
+            # urllib3 read timeouts and connection errors
+            abort(504)
+
+        self._length += len(chunk)
+        if self._length > app.config["MAX_CONTENT_LENGTH"]:
+            abort(413)
+
+        return chunk
+
 def store_url(url, addr, ua, secret: bool):
     if is_fhost_url(url):
         abort(400)
 
-    h = { "Accept-Encoding" : "identity" }
-    r = requests.get(url, stream=True, verify=False, headers=h)
+    slot = fetch_slot()
+    if not slot:
+        abort(503)
 
-    try:
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        return str(e) + "\n"
+    with slot:
+        h = { "Accept-Encoding" : "identity" }
 
-    if "content-length" in r.headers:
-        l = int(r.headers["content-length"])
+        try:
+            r = fetch_session.get(url, stream=True, verify=False, headers=h,
+                                  timeout=(app.config["FHOST_FETCH_CONNECT_TIMEOUT"],
+                                           app.config["FHOST_FETCH_READ_TIMEOUT"]))
+        except requests.exceptions.Timeout:
+            abort(504)
+        except requests.exceptions.RequestException as e:
+            return str(e) + "\n"
+
+        with r:
+            try:
+                r.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                return str(e) + "\n"
 
-        if l <= app.config["MAX_CONTENT_LENGTH"]:
-            def urlfile(**kwargs):
-                return type('',(),kwargs)()
+            # Reject files that are too large right away if we know the size,
+            # otherwise the limit is enforced while reading
+            if int(r.headers.get("content-length", 0)) > app.config["MAX_CONTENT_LENGTH"]:
+                abort(413)
 
-            f = urlfile(read=r.raw.read, content_type=r.headers["content-type"], filename="")
+            return store_file(RemoteFile(r), None, addr, ua, secret)
 
-            return store_file(f, None, addr, ua, secret)
+"""
+Returns the Cache-Control header for a file according to the configured
+policies, where {max_age} is replaced with the number of seconds until the
+file expires.
+"""
+def cache_control(f) -> typing.Optional[str]:
+    if f.secret:
+        policy = app.config["FHOST_CACHE_CONTROL_SECRET"]
+    elif f.is_nsfw:
+        policy = app.config["FHOST_CACHE_CONTROL_NSFW"]
+    else:
+        policy = app.config["FHOST_CACHE_CONTROL"]
+
+    if not policy:
+        return None
+
+    max_age = max(0, int((f.expiration or 0) / 1000 - time.time()))
+    return policy.format(max_age=max_age)
+
+def read_range(fo, start: int, length: int):
+    with fo:
+        fo.seek(start)
+        while length > 0:
+            chunk = fo.read(min(length, app.config["FHOST_CHUNK_SIZE"]))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+"""
+Serves a stored file, honouring Range and If-Range requests.
+
+Whole files are handed to the server's wsgi.file_wrapper so it can use
+sendfile().  Ranges are always read in Python, since some servers (e.g.
+uWSGI) ignore the file position and would send the file from the start.
+"""
+def send_object(fpath: Path, mime: str, etag: str) -> Response:
+    size = fpath.stat().st_size
+
+    if app.config["USE_X_SENDFILE"]:
+        response = Response(content_type = mime)
+        response.headers["Content-Length"] = size
+        response.headers["X-Sendfile"] = str(fpath.absolute())
+        return response
+
+    rng = request.range
+
+    if rng and "If-Range" in request.headers and request.if_range.etag != etag:
+        # The client has an outdated copy, it gets the whole file
+        rng = None
+
+    if rng and (rng.units != "bytes" or len(rng.ranges) > app.config["FHOST_MAX_RANGES"]):
+        rng = None
+
+    if not rng:
+        response = Response(wrap_file(request.environ, open(fpath, "rb")),
+                            content_type = mime, direct_passthrough = True)
+        response.headers["Content-Length"] = size
+        response.headers["Accept-Ranges"] = "bytes"
+        return response
+
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start = max(0, size + start)
+            stop = size
         else:
-            abort(413)
+            stop = min(stop or size, size)
+
+        if start < stop:
+            ranges.append((start, stop))
+
+    if not ranges:
+        response = make_response("", 416)
+        response.headers["Content-Range"] = f"bytes */{size}"
+        return response
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        fo = open(fpath, "rb")
+
+        if start == 0 and stop == size:
+            body = wrap_file(request.environ, fo)
+        else:
+            body = read_range(fo, start, stop - start)
+
+        response = Response(body, 206, content_type = mime, direct_passthrough = True)
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        response.headers["Content-Length"] = stop - start
     else:
-        abort(411)
+        boundary = secrets.token_hex(16)
+        parts = [(f"--{boundary}\r\nContent-Type: {mime}\r\n"
+                  f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode()
+                 for start, stop in ranges]
+        end = f"--{boundary}--\r\n".encode()
+
+        def multipart():
+            for (start, stop), header in zip(ranges, parts):
+                yield header
+                yield from read_range(open(fpath, "rb"), start, stop - start)
+                yield b"\r\n"
+            yield end
+
+        response = Response(multipart(), 206, direct_passthrough = True,
+                            content_type = f"multipart/byteranges; boundary={boundary}")
+        response.headers["Content-Length"] = sum(len(h) + stop - start + 2
+                                                 for (start, stop), h in zip(ranges, parts)) + len(end)
+
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
 
 def manage_file(f):
     try:
@@ -429,6 +1173,8 @@ def manage_file(f):
             abort(400)
 
         f.expiration = File.get_expiration(requested_expiration, f.size)
+        f.notify_expiry()
+        invalidate_meta([f.id])
         db.session.commit()
         return "", 202
 
@@ -444,10 +1190,23 @@ def get(path, secret=None):
     if "." in name:
         abort(404)
 
+    # Reject anything that can't be a valid ID without asking the database
+    if not name or not set(name) <= url_alphabet:
+        abort(404)
+
     id = su.debase(name)
 
     if sufs:
-        f = File.query.get(id)
+        if beyond_max_id(File, id) or miss_cache.get((File, id)):
+            abort(404)
+
+        if request.method == "POST":
+            f = File.query.get(id)
+        else:
+            f = get_file_meta(id)
+
+        if not f:
+            remember_miss(File, id)
 
         if f and f.ext == sufs:
             if f.secret != secret:
@@ -456,21 +1215,61 @@ def get(path, secret=None):
             if f.removed:
                 abort(451)
 
+            if request.method == "POST":
+                if not f.getpath().is_file():
+                    abort(404)
+
+                return manage_file(f)
+
+            encoded = f.compression and request.accept_encodings[f.compression]
+
+            # Files never change, so the hash identifies the content
+            etag = f.sha256 + (f"-{f.compression}" if encoded else "")
+            cache = cache_control(f)
+
+            if f.expiration is not None and request.if_none_match.contains_weak(etag):
+                response = make_response("", 304)
+                response.set_etag(etag)
+                if cache:
+                    response.headers["Cache-Control"] = cache
+                if f.compression:
+                    response.headers["Vary"] = "Accept-Encoding"
+                response.headers["X-Expires"] = f.expiration
+                return response
+
             fpath = f.getpath()
 
             if not fpath.is_file():
                 abort(404)
 
-            if request.method == "POST":
-                return manage_file(f)
+            get_storage().accessed(f.sha256)
 
-            if app.config["FHOST_USE_X_ACCEL_REDIRECT"]:
+            if f.compression and not encoded:
+                # The client can't handle the compressed data, so decompress
+                # it on the fly
+                def decompress():
+                    with f.open() as fo:
+                        while chunk := fo.read(app.config["FHOST_CHUNK_SIZE"]):
+                            yield chunk
+
+                response = Response(decompress(), content_type = f.mime)
+                response.headers["Content-Length"] = f.size
+            elif app.config["FHOST_USE_X_ACCEL_REDIRECT"]:
                 response = make_response()
                 response.headers["Content-Type"] = f.mime
-                response.headers["Content-Length"] = f.size
+                response.headers["Content-Length"] = fpath.stat().st_size if encoded else f.size
                 response.headers["X-Accel-Redirect"] = "/" + str(fpath)
             else:
-                response = send_from_directory(app.config["FHOST_STORAGE_PATH"], f.sha256, mimetype = f.mime)
+                response = send_object(fpath, f.mime, etag)
+
+            response.set_etag(etag)
+            if cache:
+                response.headers["Cache-Control"] = cache
+
+            if f.compression:
+                response.headers["Vary"] = "Accept-Encoding"
+                if encoded:
+                    response.headers["Content-Encoding"] = f.compression
 
             response.headers["X-Expires"] = f.expiration
             return response
@@ -481,13 +1280,91 @@ def get(path, secret=None):
         if "/" in path:
             abort(404)
 
-        u = URL.query.get(id)
+        if beyond_max_id(URL, id) or miss_cache.get((URL, id)):
+            abort(404)
+
+        target = redirect_cache.get(id)
+
+        if not target:
+            u = URL.query.get(id)
+
+            if u:
+                target = u.url
+                redirect_cache.set(id, target)
+
+        if target:
+            response = redirect(target)
 
-        if u:
-            return redirect(u.url)
+            if app.config["FHOST_REDIRECT_CACHE_CONTROL"]:
+                response.headers["Cache-Control"] = app.config["FHOST_REDIRECT_CACHE_CONTROL"]
+
+            return response
+
+        remember_miss(URL, id)
 
     abort(404)
 
+_ratelimiters = {}
+
+def get_ratelimiter() -> RateLimiter:
+    path = app.config["FHOST_RATELIMIT_PATH"] or os.path.join(tempfile.gettempdir(), "0x0-ratelimit.sqlite")
+
+    if path not in _ratelimiters:
+        _ratelimiters[path] = RateLimiter(path)
+
+    return _ratelimiters[path]
+
+"""
+Turns away uploads from clients exceeding FHOST_UPLOAD_RATE or
+FHOST_UPLOAD_BYTE_RATE, and any upload that would exceed
+FHOST_UPLOAD_INFLIGHT_BYTES, before their body is read.
+"""
+@app.before_request
+def admit_upload():
+    if (request.method, request.endpoint) not in (("POST", "fhost"), ("PATCH", "resumable")):
+        return
+
+    rate = app.config["FHOST_UPLOAD_RATE"]
+    byte_rate = app.config["FHOST_UPLOAD_BYTE_RATE"]
+    inflight = app.config["FHOST_UPLOAD_INFLIGHT_BYTES"]
+
+    if not (rate or byte_rate or inflight):
+        return
+
+    # Without a Content-Length, assume the worst
+    length = request.content_length
+    if length is None:
+        length = app.config["MAX_CONTENT_LENGTH"]
+
+    limiter = get_ratelimiter()
+    key = client_key(request.remote_addr, app.config["FHOST_RATELIMIT_V6_PREFIX"])
+    buckets = []
+
+    # Parts of resumable uploads only count towards the byte rate
+    if rate and request.method == "POST":
+        buckets.append((f"req:{key}", 1, rate, app.config["FHOST_UPLOAD_BURST"]))
+    if byte_rate:
+        buckets.append((f"bytes:{key}", length, byte_rate, app.config["FHOST_UPLOAD_BYTE_BURST"]))
+
+    if buckets:
+        wait = limiter.take(buckets)
+        if wait:
+            raise TooManyRequests(retry_after=int(wait) + 1)
+
+    if inflight:
+        rid = limiter.reserve(length, inflight)
+        if rid is None:
+            raise ServiceUnavailable(retry_after=5)
+
+        g.upload_reservation = rid
+
+@app.teardown_request
+def release_upload(exc):
+    rid = g.pop("upload_reservation", None)
+
+    if rid is not None:
+        get_ratelimiter().release(rid)
+
 @app.route("/", methods=["GET", "POST"])
 def fhost():
     if request.method == "POST":
@@ -516,6 +1393,37 @@ def fhost():
                     request.user_agent.string,
                     secret
                 )
+        elif "sha256" in request.form:
+            try:
+                size = int(request.form["size"])
+                expires = int(request.form["expires"]) if "expires" in request.form else None
+            except (KeyError, ValueError):
+                abort(400)
+
+            return store_hash(
+                request.form["sha256"],
+                size,
+                expires,
+                request.remote_addr,
+                request.user_agent.string,
+                secret
+            )
+        elif "resumable" in request.form:
+            try:
+                size = int(request.form["resumable"])
+                expires = int(request.form["expires"]) if "expires" in request.form else None
+            except ValueError:
+                abort(400)
+
+            return start_resumable(
+                size,
+                request.form.get("filename", ""),
+                request.form.get("type"),
+                expires,
+                request.remote_addr,
+                request.user_agent.string,
+                secret
+            )
         elif "url" in request.form:
             return store_url(
                 request.form["url"],
@@ -530,6 +1438,139 @@ def fhost():
     else:
         return render_template("index.html")
 
+"""
+Starts a resumable upload of size bytes.  The client then sends the data in
+any number of PATCH requests to the returned URL, each with an Upload-Offset
+header giving the position of its body in the file.
+"""
+def start_resumable(size: int, filename, mime, requested_expiration: typing.Optional[int], addr, ua, secret: bool):
+    if in_upload_bl(addr):
+        return "Your host is blocked from uploading files.\n", 451
+
+    if size < 0:
+        abort(400)
+    if size > app.config["MAX_CONTENT_LENGTH"]:
+        abort(413)
+
+    us = UploadSession(size, filename, mime, requested_expiration, secret, addr, ua)
+    us.getpath().parent.mkdir(parents=True, exist_ok=True)
+    us.getpath().touch(0o600)
+
+    db.session.add(us)
+    db.session.commit()
+
+    response = make_response(us.geturl(), 201)
+    response.headers["Location"] = us.geturl().rstrip()
+    response.headers["Upload-Offset"] = 0
+    response.headers["Upload-Length"] = us.size
+
+    return response
+
+"""
+Appends the request body to a resumable upload, storing the file once it is
+complete.  Whatever arrives before the connection drops is kept.
+"""
+def append_resumable(us: UploadSession):
+    try:
+        offset = int(request.headers["Upload-Offset"])
+    except (KeyError, ValueError):
+        abort(400)
+
+    if offset != us.offset:
+        response = make_response("Upload-Offset does not match, resume from here.\n", 409)
+        response.headers["Upload-Offset"] = us.offset
+        return response
+
+    if offset + (request.content_length or 0) > us.size:
+        abort(413)
+
+    h = SHA256State(us.hash_state) if us.hash_state else None
+    path = us.getpath()
+
+    try:
+        with open(path, "r+b") as of:
+            # Drop anything written after the last recorded offset
+            of.truncate(us.offset)
+            of.seek(us.offset)
+
+            while chunk := request.stream.read(app.config["FHOST_CHUNK_SIZE"]):
+                if us.offset + len(chunk) > us.size:
+                    abort(413)
+
+                of.write(chunk)
+                us.offset += len(chunk)
+
+                if h:
+                    h.update(chunk)
+    finally:
+        us.hash_state = h.state if h else None
+        us.updated = datetime.datetime.now()
+        db.session.commit()
+
+    if us.offset < us.size:
+        response = make_response("", 204)
+        response.headers["Upload-Offset"] = us.offset
+        return response
+
+    if h:
+        digest = h.hexdigest()
+    else:
+        with open(path, "rb") as f:
+            h = sha256()
+            while chunk := f.read(app.config["FHOST_CHUNK_SIZE"]):
+                h.update(chunk)
+            digest = h.hexdigest()
+
+    os.chmod(path, 0o666 & ~_umask)
+
+    if in_upload_bl(us.addr):
+        us.delete()
+        db.session.commit()
+        return "Your host is blocked from uploading files.\n", 451
+
+    # The staging file is moved into storage or removed either way, and the
+    # session only goes away after that, so prune can still clean up after
+    # a crash in between
+    token = us.token
+
+    try:
+        sf, isnew = File.store_spooled(path, digest, us.size, us.filename or "", us.mime,
+                                       us.expires, us.addr, us.ua, us.secret)
+    except:
+        db.session.rollback()
+        UploadSession.query.filter_by(token=token).delete()
+        db.session.commit()
+        raise
+
+    db.session.delete(us)
+    db.session.commit()
+
+    return stored_response(sf, isnew)
+
+@app.route("/~upload/<token>", methods=["GET", "HEAD", "PATCH", "DELETE"])
+def resumable(token):
+    us = UploadSession.query.get(token)
+    if not us:
+        abort(404)
+
+    if request.method == "PATCH":
+        storage = get_storage()
+
+        with digest_lock(storage.tmpdir, token):
+            db.session.refresh(us)
+            return append_resumable(us)
+    elif request.method == "DELETE":
+        us.delete()
+        db.session.commit()
+        return "", 204
+
+    response = make_response(f"{us.offset}/{us.size}\n")
+    response.headers["Upload-Offset"] = us.offset
+    response.headers["Upload-Length"] = us.size
+    response.headers["Cache-Control"] = "no-store"
+
+    return response
+
 @app.route("/robots.txt")
 def robots():
     return """User-agent: *
@@ -543,66 +1584,393 @@ Disallow: /
 @app.errorhandler(413)
 @app.errorhandler(414)
 @app.errorhandler(415)
+@app.errorhandler(429)
 @app.errorhandler(451)
+@app.errorhandler(503)
+@app.errorhandler(504)
 def ehandler(e):
+    # Pages for errors caused by scanners are only rendered once, with the
+    # request path filled in afterwards.  Templates for these only have
+    # access to request.path.
+    if e.code in (404, 451):
+        if not e.code in _error_pages:
+            _error_pages[e.code] = render_error(e.code, _PlaceholderRequest)
+
+        page = _error_pages[e.code].replace(_PlaceholderRequest.path, str(escape(request.path)))
+        return page, e.code
+
+    headers = {}
+    if getattr(e, "retry_after", None) is not None:
+        headers["Retry-After"] = str(e.retry_after)
+
+    return render_error(e.code, request), e.code, headers
+
+def render_error(code, request):
     try:
-        return render_template(f"{e.code}.html", id=id, request=request), e.code
+        return render_template(f"{code}.html", id=id, request=request)
     except TemplateNotFound:
-        return "Segmentation fault\n", e.code
+        return "Segmentation fault\n"
+
+class _PlaceholderRequest:
+    path = "\x00path\x00"
+
+_error_pages = {}
 
 @app.cli.command("prune")
-def prune():
+@click.option("--batch-size", type=int, default=1000, show_default=True,
+              help="Number of files to remove between commits")
+@click.option("-j", "--jobs", type=int, default=1, show_default=True,
+              help="Number of files to remove concurrently")
+@click.option("--max-files", type=float, default=None,
+              help="Maximum number of files to remove per second")
+@click.option("--max-bytes", type=float, default=None,
+              help="Maximum number of bytes to remove per second")
+@click.option("--dry-run", is_flag=True,
+              help="Only count the files that would be removed")
+@click.option("--daemon", is_flag=True,
+              help="Keep running and remove files as soon as they expire")
+def prune(batch_size, jobs, max_files, max_bytes, dry_run, daemon):
     """
     Clean up expired files
 
     Deletes any files from the filesystem which have hit their expiration time.  This
     doesn't remove them from the database, only from the filesystem.  It's recommended
     that server owners run this command regularly, or set it up on a timer.
+
+    Alternatively, run it with --daemon to remove files as they expire.
     """
+    if daemon:
+        return prune_daemon(batch_size, max_files)
+
     current_time = time.time() * 1000;
 
-    # The path to where uploaded files are stored
-    storage = Path(app.config["FHOST_STORAGE_PATH"])
+    storage = get_storage()
 
-    # A list of all files who've passed their expiration times
-    expired_files = File.query\
-        .where(
-            and_(
-                File.expiration.is_not(None),
-                File.expiration < current_time
-            )
-        )
+    # Deletions are spread out evenly across all threads if requested
+    pace_lock = threading.Lock()
+    next_slot = time.time()
 
-    files_removed = 0;
+    def pace(file):
+        nonlocal next_slot
 
-    # For every expired file...
-    for file in expired_files:
-        # Log the file we're about to remove
-        file_name = file.getname()
-        file_hash = file.sha256
-        file_path = storage / file_hash
-        print(f"Removing expired file {file_name} [{file_hash}]")
+        cost = max(1 / max_files if max_files else 0,
+                   (file.size or 0) / max_bytes if max_bytes else 0)
+
+        with pace_lock:
+            now = time.time()
+            start = max(now, next_slot)
+            next_slot = start + cost
+
+        if start > now:
+            time.sleep(start - now)
+
+    def remove(file):
+        pace(file)
 
-        # Remove it from the file system
         try:
-            os.remove(file_path)
-            files_removed += 1;
-        except FileNotFoundError:
-            pass # If the file was already gone, we're good
+            return storage.delete(file.sha256), None
         except OSError as e:
-            print(e)
-            print(
-                "\n------------------------------------"
-                "Encountered an error while trying to remove file {file_path}.  Double"
-                "check to make sure the server is configured correctly, permissions are"
-                "okay, and everything is ship shape, then try again.")
-            return;
-
-        # Finally, mark that the file was removed
-        file.expiration = None;
+            return False, e
+
+    files_removed = 0;
+    files_failed = 0;
+    bytes_removed = 0;
+    last_id = 0
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(jobs) as pool:
+        while True:
+            # The next batch of files who've passed their expiration times
+            expired_files = db.session.query(File.id, File.sha256, File.size)\
+                .where(
+                    and_(
+                        File.expiration.is_not(None),
+                        File.expiration < current_time,
+                        File.id > last_id
+                    )
+                )\
+                .order_by(File.id).limit(batch_size).all()
+
+            if not expired_files:
+                break
+
+            last_id = expired_files[-1].id
+            batch_bytes = sum(file.size or 0 for file in expired_files)
+
+            if dry_run:
+                files_removed += len(expired_files)
+                bytes_removed += batch_bytes
+                continue
+
+            done = []
+            for file, (removed, e) in zip(expired_files, pool.map(remove, expired_files)):
+                file_name = su.enbase(file.id)
+
+                if e:
+                    # Leave it for the next run
+                    print(f"Error removing expired file {file_name} [{file.sha256}]: {e}")
+                    files_failed += 1
+                    continue
+
+                print(f"Removed expired file {file_name} [{file.sha256}]")
+                if removed:
+                    files_removed += 1;
+                    bytes_removed += file.size or 0
+
+                # Finally, mark that the file was removed
+                done.append(file.id)
+
+            File.query.filter(File.id.in_(done))\
+                .update({ File.expiration : None }, synchronize_session=False)
+            invalidate_meta(done)
+            db.session.commit()
+
+    if dry_run:
+        print(f"{files_removed} file(s) would be removed ({bytes_removed} bytes)")
+        return
+
+    prune_resumable()
+
+    # Left over from a daemon that isn't running, which loads everything it
+    # needs from the file table when it starts anyway
+    ExpiryEvent.query.delete()
     db.session.commit()
 
-    print(f"\nDone!  {files_removed} file(s) removed")
+    print(f"\nDone!  {files_removed} file(s) removed ({bytes_removed} bytes)")
+
+    if files_failed:
+        print(
+            f"\n{files_failed} file(s) could not be removed.  Double check to make sure "
+            "the server is configured correctly, permissions are okay, and everything "
+            "is ship shape, then try again.")
+
+"""
+Removes resumable uploads that haven't received any data within
+FHOST_RESUMABLE_TTL, along with their staging files.  Staging and spool files
+of that age that no upload refers to anymore, e.g. after a crash, are
+removed as well.
+"""
+def prune_resumable():
+    cutoff = datetime.datetime.now() - app.config["FHOST_RESUMABLE_TTL"]
+
+    for us in UploadSession.query.filter(UploadSession.updated < cutoff):
+        print(f"Removed abandoned upload {us.token} ({us.offset}/{us.size} bytes)")
+        us.delete()
+
+    db.session.commit()
+
+    tmpdir = get_storage().tmpdir
+    if not tmpdir.is_dir():
+        return
+
+    for p in list(tmpdir.glob(".resumable-*")) + list(tmpdir.glob(".upload-*")):
+        try:
+            if p.stat().st_mtime >= cutoff.timestamp():
+                continue
+        except FileNotFoundError:
+            continue
+
+        if p.name.startswith(".resumable-") and \
+                UploadSession.query.get(p.name[len(".resumable-"):]):
+            continue
+
+        print(f"Removed leftover temporary file {p.name}")
+        p.unlink(missing_ok=True)
+
+"""
+Removes files close to their expiration time, at a steady rate of at most
+max_files per second.
+
+Keeps a heap of files expiring within FHOST_PRUNE_HORIZON, which is refilled
+from the database every half horizon in batches of batch_size, or sooner if
+the last batch was full.  Files whose expiration is moved into that window
+after they were loaded are picked up through the expiry_event table.
+
+Abandoned resumable uploads are removed every FHOST_RESUMABLE_TTL / 2, as that
+needs to look through all of the storage directory.
+"""
+def prune_daemon(batch_size, max_files):
+    import heapq
+
+    storage = get_storage()
+    horizon = app.config["FHOST_PRUNE_HORIZON"].total_seconds()
+    heap = []
+    scheduled = {}
+    next_load = 0
+    truncated = False
+    next_resumable = 0
+
+    def schedule(id, expiration):
+        if scheduled.get(id) != expiration:
+            scheduled[id] = expiration
+            heapq.heappush(heap, (expiration, id))
+
+    while True:
+        now = time.time()
+
+        # New files within the horizon arrive as events, so there is only
+        # more to load early if the last batch didn't fit everything
+        if now >= next_load or (truncated and not heap):
+            loaded = db.session.query(File.id, File.expiration)\
+                    .filter(File.expiration.is_not(None),
+                            File.expiration < (now + horizon) * 1000)\
+                    .order_by(File.expiration).limit(batch_size).all()
+
+            for id, expiration in loaded:
+                schedule(id, expiration)
+
+            truncated = len(loaded) == batch_size
+            next_load = now + horizon / 2
+
+        if now >= next_resumable:
+            prune_resumable()
+            next_resumable = now + app.config["FHOST_RESUMABLE_TTL"].total_seconds() / 2
+
+        # Handled events are deleted, so everything left is new.  SQLite
+        # reuses IDs once the table is empty, so they can't be compared to
+        # those seen before.
+        events = ExpiryEvent.query.order_by(ExpiryEvent.id).all()
+
+        if events:
+            last_event = events[-1].id
+            ids = [e.file_id for e in events]
+
+            for id, expiration in db.session.query(File.id, File.expiration)\
+                    .filter(File.id.in_(ids), File.expiration.is_not(None)):
+                if expiration < (now + horizon) * 1000:
+                    schedule(id, expiration)
+
+            ExpiryEvent.query.filter(ExpiryEvent.id <= last_event).delete()
+
+        db.session.commit()
+
+        while heap and heap[0][0] <= time.time() * 1000:
+            expiration, id = heapq.heappop(heap)
+
+            if scheduled.get(id) != expiration:
+                continue # superseded by a later entry
+
+            del scheduled[id]
+
+            # The expiration might have changed since the file was scheduled
+            f = db.session.query(File.id, File.sha256, File.expiration)\
+                .filter(File.id == id).first()
+
+            if not f or f.expiration is None:
+                continue
+
+            if f.expiration > time.time() * 1000:
+                if f.expiration < (time.time() + horizon) * 1000:
+                    schedule(id, f.expiration)
+                continue
+
+            try:
+                storage.delete(f.sha256)
+            except OSError as e:
+                print(f"Error removing expired file {su.enbase(id)} [{f.sha256}]: {e}")
+                continue
+
+            print(f"Removed expired file {su.enbase(id)} [{f.sha256}]")
+            File.query.filter(File.id == id)\
+                .update({ File.expiration : None }, synchronize_session=False)
+            invalidate_meta([id])
+            db.session.commit()
+
+            if max_files:
+                time.sleep(1 / max_files)
+
+        wait = app.config["FHOST_PRUNE_POLL_INTERVAL"]
+        if heap:
+            wait = min(wait, max(0, heap[0][0] / 1000 - time.time()))
+
+        time.sleep(wait)
+
+@app.cli.command("shard-storage")
+@click.option("--batch-size", type=int, default=1000, show_default=True,
+              help="Number of files to move before pausing")
+@click.option("--delay", type=float, default=0.1, show_default=True,
+              help="Seconds to pause between batches")
+def shard_storage(batch_size, delay):
+    """
+    Move files into the sharded storage layout
+
+    Moves files stored directly in FHOST_STORAGE_PATH into the subdirectories
+    given by FHOST_STORAGE_SHARD_DEPTH.  Files are served from both locations
+    while this is running, so it can be done without stopping the service.
+    """
+    if not app.config["FHOST_STORAGE_SHARD_DEPTH"]:
+        print("Error: Sharding is disabled. Please set FHOST_STORAGE_SHARD_DEPTH.")
+        sys.exit(1)
+
+    moved = 0
+
+    for tier in get_storage().tiers:
+        for digest in tier.unsharded():
+            try:
+                tier.shard(digest)
+            except FileNotFoundError:
+                # Removed since the directory was listed
+                continue
+
+            moved += 1
+
+            if moved % batch_size == 0:
+                print(f"{moved} file(s) moved")
+                time.sleep(delay)
+
+    print(f"\nDone!  {moved} file(s) moved")
+
+@app.cli.command("tier")
+@click.option("--dry-run", is_flag=True, help="Only show what would be moved")
+def tier(dry_run):
+    """
+    Move files between storage tiers
+
+    Files on the fast tier that are at least FHOST_TIER_MIN_SIZE bytes large
+    and haven't been downloaded for FHOST_TIER_COLD_AFTER are moved to the
+    slow tier.  Files on the slow tier that were downloaded within
+    FHOST_TIER_HOT_WITHIN are moved back.  It's recommended to run this
+    command regularly, or set it up on a timer.
+    """
+    storage = get_storage()
+
+    if not isinstance(storage, TieredStorage):
+        print("Error: Tiered storage is disabled. Please set FHOST_STORAGE_BACKEND to \"tiered\".")
+        sys.exit(1)
+
+    now = time.time()
+    cold_after = app.config["FHOST_TIER_COLD_AFTER"].total_seconds()
+    hot_within = app.config["FHOST_TIER_HOT_WITHIN"].total_seconds()
+    demoted = promoted = 0
+    moved_bytes = 0
+
+    for digest, p in storage.hot.objects():
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+
+        if st.st_size >= app.config["FHOST_TIER_MIN_SIZE"] and now - st.st_atime > cold_after:
+            print(f"Moving {digest} to cold tier")
+            if not dry_run:
+                storage.demote(digest)
+            demoted += 1
+            moved_bytes += st.st_size
+
+    for digest, p in storage.cold.objects():
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+
+        if now - st.st_atime <= hot_within:
+            print(f"Moving {digest} to hot tier")
+            if not dry_run:
+                storage.promote(digest)
+            promoted += 1
+            moved_bytes += st.st_size
+
+    print(f"\nDone!  {demoted} file(s) moved to cold tier, {promoted} file(s) moved to hot tier ({moved_bytes} bytes)")
 
 """ For a file of a given size, determine the largest allowed lifespan of that file
 
@@ -620,20 +1988,93 @@ def get_max_lifespan(filesize: int) -> int:
     max_size = app.config.get("MAX_CONTENT_LENGTH", 256 * 1024 * 1024)
     return min_exp + int((-max_exp + min_exp) * (filesize / max_size - 1) ** 3)
 
+"""
+Asks clamd for the version of its signature database, which is the second
+field of its VERSION reply, e.g. "ClamAV 1.0.1/26853/Mon Mar 20 07:48:19 2023".
+"""
+def vscan_signature_version() -> typing.Optional[int]:
+    try:
+        return int(app.config["VSCAN_SOCKET"].version().split("/")[1])
+    except:
+        return None
+
+_clamd_reply = re.compile(r"^(?P<path>.*?): ((?P<reason>.+) )?(?P<status>FOUND|OK|ERROR)$")
+
+"""
+Has clamd scan an open file by passing it the file descriptor over its unix
+socket, so it never has to be copied through the socket.
+"""
+def vscan_fildes(fobj) -> tuple:
+    cd = app.config["VSCAN_SOCKET"]
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(getattr(cd, "timeout", None))
+        s.connect(cd.unix_socket)
+        s.sendall(b"zFILDES\0")
+        socket.send_fds(s, [b"\0"], [fobj.fileno()])
+
+        reply = b""
+        while not reply.endswith(b"\0"):
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+
+    m = _clamd_reply.match(reply.rstrip(b"\0").decode("utf-8", "replace"))
+    if not m:
+        raise ValueError(f"Unexpected reply from clamd: {reply!r}")
+
+    return (m["status"], m["reason"])
+
 def do_vscan(f):
     if f["path"].is_file():
-        with open(f["path"], "rb") as scanf:
-            try:
-                f["result"] = list(app.config["VSCAN_SOCKET"].instream(scanf).values())[0]
-            except:
-                f["result"] = ("SCAN FAILED", None)
+        cd = app.config["VSCAN_SOCKET"]
+        mode = app.config["VSCAN_MODE"]
+
+        # clamd would only see the compressed bytes, so those have to be
+        # decompressed on our side and streamed
+        if f["compression"]:
+            mode = "instream"
+
+        try:
+            if mode in ("scan", "multiscan"):
+                path = str(f["path"].resolve())
+                f["result"] = tuple(getattr(cd, mode)(path)[path])
+            elif mode == "fildes":
+                with open(f["path"], "rb") as scanf:
+                    f["result"] = vscan_fildes(scanf)
+            else:
+                with open_object(f["path"], f["compression"]) as scanf:
+                    f["result"] = tuple(list(cd.instream(scanf).values())[0])
+        except:
+            f["result"] = ("SCAN FAILED", None)
+
+        # e.g. clamd not being allowed to read the file
+        if f["result"][0] == "ERROR":
+            f["result"] = ("SCAN FAILED", f["result"][1])
     else:
         f["result"] = ("FILE NOT FOUND", None)
 
     return f
 
 @app.cli.command("vscan")
-def vscan():
+@click.option("-j", "--jobs", type=int, default=None,
+              help="Number of files to scan concurrently (default: one per CPU core)")
+@click.option("--batch-size", type=int, default=100, show_default=True,
+              help="Number of files to scan between commits")
+@click.option("--limit", type=int, default=None,
+              help="Stop after scanning this many files")
+@click.option("--time-budget", type=float, default=None,
+              help="Stop after this many seconds")
+def vscan(jobs, batch_size, limit, time_budget):
+    """
+    Scan files for viruses
+
+    Scans all files that haven't been scanned within VSCAN_INTERVAL with
+    ClamAV, unless its signatures haven't changed since.  Results are
+    committed after every batch, so an interrupted run can simply be
+    started again.
+    """
     if not app.config["VSCAN_SOCKET"]:
         print("""Error: Virus scanning enabled but no connection method specified.
 Please set VSCAN_SOCKET.""")
@@ -642,33 +2083,249 @@ Please set VSCAN_SOCKET.""")
     qp = Path(app.config["VSCAN_QUARANTINE_PATH"])
     qp.mkdir(parents=True, exist_ok=True)
 
+    sigver = vscan_signature_version()
+
+    if sigver is None:
+        print("Warning: Could not determine the signature database version.")
+
+    unscanned = and_(File.last_vscan == None, File.removed == False)
+    classes = [unscanned]
+
+    if isinstance(app.config["VSCAN_INTERVAL"], datetime.timedelta):
+        scandate = datetime.datetime.now() - app.config["VSCAN_INTERVAL"]
+        rescan = and_(File.last_vscan < scandate, File.removed == False)
+
+        # Scanning again with the same signatures won't find anything new
+        if sigver is not None:
+            rescan = and_(rescan, or_(File.vscan_signatures == None,
+                                      File.vscan_signatures < sigver))
+
+        classes.append(rescan)
+
+    # Never scanned files first, and within that and the files due for a
+    # rescan, the types most likely to be malicious first.  Each class is
+    # paged through by ID, i.e. oldest files first, so every batch is a cheap
+    # index range scan and failed files are simply left behind.
+    risky = or_(*(File.mime.like(m + "%") for m in app.config["VSCAN_RISKY_MIME"]))
+    classes = [and_(c, r) for c in classes for r in (risky, or_(~risky, File.mime == None))]
+
+    deadline = time.monotonic() + time_budget if time_budget else None
+    scanned = 0
+
+    def batches():
+        for cond in classes:
+            last_id = 0
+
+            while limit is None or scanned < limit:
+                n = batch_size if limit is None else min(batch_size, limit - scanned)
+                res = File.query.filter(cond, File.id > last_id).order_by(File.id).limit(n)
+
+                work = [{"path" : f.getpath(), "name" : f.getname(), "id" : f.id,
+                         "compression" : f.compression, "size" : f.size or 0} for f in res]
+
+                if not work:
+                    break
+
+                last_id = work[-1]["id"]
+                yield work
+
     from multiprocessing import Pool
-    with Pool() as p:
-        if isinstance(app.config["VSCAN_INTERVAL"], datetime.timedelta):
-            scandate = datetime.datetime.now() - app.config["VSCAN_INTERVAL"]
-            res = File.query.filter(or_(File.last_vscan < scandate,
-                                        File.last_vscan == None),
-                                    File.removed == False)
-        else:
-            res = File.query.filter(File.last_vscan == None, File.removed == False)
+    with Pool(jobs) as p:
+        for work in batches():
+            # Start with the largest files so the batch doesn't end with a
+            # single worker scanning a huge file
+            work.sort(key=lambda f: f["size"], reverse=True)
+
+            results = []
+            for r in p.imap_unordered(do_vscan, work):
+                if r["result"][0] != "OK":
+                    print(f"{r['name']}: {r['result'][0]} {r['result'][1] or ''}")
+
+                found = False
+                if r["result"][0] == "FOUND":
+                    if not r["result"][1] in app.config["VSCAN_IGNORE"]:
+                        shutil.move(r["path"], qp / r["name"])
+                        found = True
+
+                results.append({
+                    "id" : r["id"],
+                    "last_vscan" : None if r["result"][0] == "SCAN FAILED" else datetime.datetime.now(),
+                    "vscan_signatures" : None if r["result"][0] == "SCAN FAILED" else sigver,
+                    "removed" : found})
+
+                if deadline and time.monotonic() > deadline:
+                    break
+
+            db.session.bulk_update_mappings(File, results)
+            invalidate_meta([r["id"] for r in results if r["removed"]])
+            db.session.commit()
+            scanned += len(results)
+
+            if deadline and time.monotonic() > deadline:
+                print("Time budget exhausted")
+                break
 
-        work = [{"path" : f.getpath(), "name" : f.getname(), "id" : f.id} for f in res]
+    print(f"\nDone!  {scanned} file(s) scanned")
 
-        results = []
-        for i, r in enumerate(p.imap_unordered(do_vscan, work)):
-            if r["result"][0] != "OK":
-                print(f"{r['name']}: {r['result'][0]} {r['result'][1] or ''}")
+def nsfw_worker_init():
+    global nsfw
+    from nsfw_detect import NSFWDetector
+    nsfw = NSFWDetector(app.config["NSFW_SOCKET"],
+                        app.config["NSFW_VIDEO_SAMPLES"],
+                        app.config["NSFW_VIDEO_AGGREGATE"])
 
-            found = False
-            if r["result"][0] == "FOUND":
-                if not r["result"][1] in app.config["VSCAN_IGNORE"]:
-                    r["path"].rename(qp / r["name"])
-                    found = True
+def do_nsfw_detect(f):
+    f["score"] = nsfw.detect(str(f["path"]))
+    return f
 
-            results.append({
-                "id" : r["id"],
-                "last_vscan" : None if r["result"][0] == "SCAN FAILED" else datetime.datetime.now(),
-                "removed" : found})
+@app.cli.command("nsfw-worker")
+@click.option("-j", "--jobs", type=int, default=None,
+              help="Number of files to score concurrently (default: NSFW_WORKERS)")
+@click.option("--once", is_flag=True,
+              help="Exit once no more files are waiting to be scored")
+def nsfw_worker(jobs, once):
+    """
+    Compute NSFW scores in the background
 
-        db.session.bulk_update_mappings(File, results)
-        db.session.commit()
+    When NSFW_ASYNC is set, uploads are stored without an NSFW score so they
+    don't have to wait for the classifier.  This command picks up those files
+    and fills in their scores.  Files which fail to be scored are retried up to
+    NSFW_RETRIES times, after which they are given a score of -1.
+
+    The newest files are scored first, so new uploads don't have to wait
+    behind older files without a score.  To score those at a controlled
+    rate, e.g. after enabling NSFW_DETECT on an existing instance, use
+    nsfwscan.
+    """
+    if not app.config["NSFW_DETECT"]:
+        print("Error: NSFW detection is disabled. Please set NSFW_DETECT.")
+        sys.exit(1)
+
+    jobs = jobs or app.config["NSFW_WORKERS"] or os.cpu_count()
+    retries = {}
+
+    from multiprocessing import Pool
+    with Pool(jobs, initializer=nsfw_worker_init) as p:
+        while True:
+            now = time.time()
+            waiting = [i for i, (n, t) in retries.items() if t > now]
+
+            res = File.query.filter(File.nsfw_score == None,
+                                    File.removed == False,
+                                    File.expiration != None,
+                                    File.id.not_in(waiting))\
+                            .order_by(File.id.desc()).limit(jobs * 4)
+
+            work = [{"path" : f.getpath(), "name" : f.getname(), "id" : f.id,
+                     "mime" : f.mime} for f in res]
+
+            if not work:
+                db.session.commit()
+                if once:
+                    break
+                time.sleep(app.config["NSFW_POLL_INTERVAL"])
+                continue
+
+            results = []
+            for r in p.imap_unordered(do_nsfw_detect, work):
+                # Only media files are expected to be scored successfully
+                if r["score"] < 0 and r["mime"].startswith(("image/", "video/")):
+                    n = retries.get(r["id"], (0, 0))[0] + 1
+
+                    if n <= app.config["NSFW_RETRIES"]:
+                        print(f"{r['name']}: scoring failed, retry {n} of {app.config['NSFW_RETRIES']}")
+                        retries[r["id"]] = (n, now + app.config["NSFW_RETRY_DELAY"])
+                        continue
+
+                    print(f"{r['name']}: scoring failed, giving up")
+
+                retries.pop(r["id"], None)
+                results.append({"id" : r["id"], "nsfw_score" : r["score"]})
+
+            db.session.bulk_update_mappings(File, results)
+            db.session.commit()
+
+@app.cli.command("nsfwscan")
+@click.option("-j", "--jobs", type=int, default=None,
+              help="Number of files to score concurrently (default: NSFW_WORKERS)")
+@click.option("--failed", is_flag=True,
+              help="Also rescan files that could not be scored before")
+@click.option("--rate", type=float, default=None,
+              help="Maximum number of files to score per second")
+@click.option("--batch-size", type=int, default=100, show_default=True,
+              help="Number of files to score between commits")
+def nsfwscan(jobs, failed, rate, batch_size):
+    """
+    Compute NSFW scores for existing files
+
+    Scores all files that don't have an NSFW score yet, for example because
+    they were uploaded before NSFW_DETECT was enabled.  Results are committed
+    after every batch, so an interrupted run can simply be started again.
+    """
+    if not app.config["NSFW_DETECT"]:
+        print("Error: NSFW detection is disabled. Please set NSFW_DETECT.")
+        sys.exit(1)
+
+    jobs = jobs or app.config["NSFW_WORKERS"] or os.cpu_count()
+
+    cond = File.nsfw_score == None
+    if failed:
+        cond = or_(cond, File.nsfw_score < 0)
+
+    start = time.time()
+    last_id = 0
+    scored = 0
+
+    from multiprocessing import Pool
+    with Pool(jobs, initializer=nsfw_worker_init) as p:
+        while True:
+            batch_start = time.time()
+            res = File.query.filter(cond,
+                                    File.removed == False,
+                                    File.expiration != None,
+                                    File.id > last_id)\
+                            .order_by(File.id).limit(batch_size)
+
+            work = [{"path" : f.getpath(), "name" : f.getname(), "id" : f.id} for f in res]
+
+            if not work:
+                break
+
+            last_id = work[-1]["id"]
+
+            results = []
+            for r in p.imap_unordered(do_nsfw_detect, work):
+                if r["score"] < 0:
+                    print(f"{r['name']}: scoring failed")
+                results.append({"id" : r["id"], "nsfw_score" : r["score"]})
+
+            db.session.bulk_update_mappings(File, results)
+            db.session.commit()
+
+            scored += len(results)
+            elapsed = time.time() - start
+            print(f"{scored} file(s) scored, {scored / elapsed:.2f} files/s")
+
+            if rate:
+                time.sleep(max(0, len(work) / rate - (time.time() - batch_start)))
+
+    elapsed = time.time() - start
+    print(f"\nDone!  {scored} file(s) scored in {elapsed:.1f}s ({scored / max(elapsed, 0.001):.2f} files/s)")
+
+@app.cli.command("nsfw-server")
+def nsfw_server():
+    """
+    Serve the NSFW classifier on NSFW_SOCKET
+
+    Loads the model once and classifies frames for all application workers,
+    batching requests that arrive at the same time.
+    """
+    if not app.config["NSFW_SOCKET"]:
+        print("Error: No socket path for the NSFW server specified. Please set NSFW_SOCKET.")
+        sys.exit(1)
+
+    from nsfw_detect import NSFWServer
+    with NSFWServer(app.config["NSFW_SOCKET"],
+                    app.config["NSFW_BATCH_SIZE"],
+                    app.config["NSFW_BATCH_WAIT"]) as server:
+        server.serve_forever()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+    Copyright © 2020 Mia Herkt
+    Licensed under the EUPL, Version 1.2 or - as soon as approved
+    by the European Commission - subsequent versions of the EUPL
+    (the "License");
+    You may not use this work except in compliance with the License.
+    You may obtain a copy of the license at:
+
+        https://joinup.ec.europa.eu/software/page/eupl
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+    either express or implied.
+    See the License for the specific language governing permissions
+    and limitations under the License.
+"""
+
+import ctypes
+import ctypes.util
+from hashlib import sha256
+
+# sizeof(SHA256_CTX): eight state words, the bit count, one block and two
+# counters, all 32 bits wide
+_CTX_SIZE = 112
+
+def _load():
+    name = ctypes.util.find_library("crypto")
+    if not name:
+        return None
+
+    try:
+        lib = ctypes.CDLL(name)
+
+        ctx = ctypes.create_string_buffer(_CTX_SIZE)
+        md = ctypes.create_string_buffer(32)
+        lib.SHA256_Init(ctx)
+        lib.SHA256_Update(ctx, b"abc", ctypes.c_size_t(3))
+        lib.SHA256_Final(md, ctx)
+    except (OSError, AttributeError):
+        return None
+
+    # Make sure the context layout is what we expect
+    if md.raw != sha256(b"abc").digest():
+        return None
+
+    return lib
+
+_libcrypto = _load()
+
+class SHA256State:
+    """
+    A SHA-256 hash whose intermediate state can be saved with the state
+    property and picked up again later, possibly by another process.
+
+    hashlib can't export its state, so this uses OpenSSL's low-level
+    functions.  If those aren't available, available is False and the data
+    has to be hashed again in one go.
+    """
+    available = _libcrypto is not None
+
+    def __init__(self, state: bytes = None):
+        if state:
+            self._ctx = ctypes.create_string_buffer(state, _CTX_SIZE)
+        else:
+            self._ctx = ctypes.create_string_buffer(_CTX_SIZE)
+            _libcrypto.SHA256_Init(self._ctx)
+
+    def update(self, data: bytes):
+        _libcrypto.SHA256_Update(self._ctx, data, ctypes.c_size_t(len(data)))
+
+    @property
+    def state(self) -> bytes:
+        return self._ctx.raw
+
+    def hexdigest(self) -> str:
+        # Finalizing destroys the context, so use a copy
+        ctx = ctypes.create_string_buffer(self._ctx.raw, _CTX_SIZE)
+        md = ctypes.create_string_buffer(32)
+        _libcrypto.SHA256_Final(md, ctx)
+        return md.raw.hex()
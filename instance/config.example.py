@@ -88,6 +88,13 @@ USE_X_SENDFILE = False
 FHOST_USE_X_ACCEL_REDIRECT = True # expect nginx by default
 
 
+# The maximum number of ranges in a single range request
+#
+# When files aren't served by the webserver, 0x0 handles range requests
+# itself.  Requests for more ranges than this get the whole file instead.
+FHOST_MAX_RANGES = 16
+
+
 # The directory that 0x0 should store uploaded files in
 #
 # Whenever a file is uploaded to 0x0, we store it here!  Relative paths are
@@ -95,6 +102,49 @@ FHOST_USE_X_ACCEL_REDIRECT = True # expect nginx by default
 FHOST_STORAGE_PATH = "up"
 
 
+# Spread stored files over subdirectories
+#
+# Very large directories get slow on most file systems.  If this is set to a
+# number greater than zero, files are stored in that many levels of
+# subdirectories named after their SHA-256 hash.  For instance, with a value of
+# 2, a file would be stored as "up/ab/cd/abcd...".
+#
+# To move existing files into the new layout, run
+#
+#   $ FLASK_APP=fhost flask shard-storage
+#
+# Files are found in either location in the meantime.
+FHOST_STORAGE_SHARD_DEPTH = 0
+
+
+# How to store uploaded files
+#
+# "local" keeps all files in FHOST_STORAGE_PATH.
+#
+# "tiered" uses FHOST_STORAGE_PATH as a fast tier (e.g. on an SSD) for new and
+# recently downloaded files, and FHOST_STORAGE_COLD_PATH as a large, slow tier
+# (e.g. on an HDD) for everything else.  Files are moved between the tiers by
+# running
+#
+#   $ FLASK_APP=fhost flask tier
+#
+# Files of at least FHOST_TIER_MIN_SIZE bytes that haven't been downloaded for
+# FHOST_TIER_COLD_AFTER are moved to the slow tier, and files on the slow tier
+# that were downloaded within FHOST_TIER_HOT_WITHIN are moved back.  Downloads
+# are recorded in the access time of the file, at most once every
+# FHOST_TIER_TOUCH_INTERVAL seconds.
+#
+# If you are using X-Accel-Redirect, make sure both paths are configured as
+# internal locations in your web server.
+from datetime import timedelta
+FHOST_STORAGE_BACKEND = "local"
+FHOST_STORAGE_COLD_PATH = None
+FHOST_TIER_COLD_AFTER = timedelta(days=7)
+FHOST_TIER_HOT_WITHIN = timedelta(days=1)
+FHOST_TIER_MIN_SIZE = 1024 * 1024
+FHOST_TIER_TOUCH_INTERVAL = 3600
+
+
 # The maximum acceptable user-specified file extension
 #
 # When a user uploads a file, in most cases, we keep the file extension they
@@ -112,6 +162,39 @@ FHOST_MAX_EXT_LENGTH = 9
 # each byte results in approximately 1.3 characters.
 FHOST_SECRET_BYTES = 16
 
+
+# The size of the chunks uploads are read in, in bytes
+#
+# Uploads are written to a temporary file in FHOST_STORAGE_PATH piece by piece
+# instead of being held in memory as a whole, so this bounds the amount of
+# memory each upload needs.
+FHOST_CHUNK_SIZE = 64 * 1024
+
+
+# Compress files of certain types on disk
+#
+# Can be set to "gzip" or "zstd" (which requires the zstandard module) to
+# compress files whose MIME type is in FHOST_COMPRESS_MIME when they are
+# stored.  Compressed files are sent as they are to clients that support the
+# encoding, and decompressed on the fly for all others.
+#
+# If you are using X-Accel-Redirect with nginx, add
+#
+#   add_header Content-Encoding $upstream_http_content_encoding;
+#
+# to the internal location for FHOST_STORAGE_PATH, as nginx doesn't pass this
+# header on by itself.
+FHOST_COMPRESSION = None
+FHOST_COMPRESS_MIME = [
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+    "text/csv",
+    "text/html",
+    "text/plain",
+    "text/x-diff",
+]
+
 # A list of filetypes to use when the uploader doesn't specify one
 #
 # When a user uploads a file with no file extension, we try to find an extension that
@@ -153,15 +236,112 @@ FHOST_MIME_BLACKLIST = [
 ]
 
 
+# Limits for fetching remote files
+#
+# When a user asks 0x0 to fetch a file from a URL, at most
+# FHOST_FETCH_CONCURRENCY such downloads run at once on this machine; further
+# requests are answered with 503 SERVICE UNAVAILABLE.  The slots are shared
+# between processes through lock files in FHOST_FETCH_LOCK_PATH (None means the
+# system's temporary directory).
+#
+# Connecting to the remote server may take FHOST_FETCH_CONNECT_TIMEOUT
+# seconds, and it may not stay silent for longer than FHOST_FETCH_READ_TIMEOUT
+# seconds.  The whole download has to be done within FHOST_FETCH_DEADLINE
+# seconds.  Otherwise, the request fails with 504 GATEWAY TIMEOUT.
+FHOST_FETCH_CONCURRENCY = 8
+FHOST_FETCH_CONNECT_TIMEOUT = 10
+FHOST_FETCH_READ_TIMEOUT = 30
+FHOST_FETCH_DEADLINE = 600
+FHOST_FETCH_LOCK_PATH = None
+
+
+# Settings for "flask prune --daemon"
+#
+# The daemon keeps track of files expiring within FHOST_PRUNE_HORIZON.  It
+# checks for changes every FHOST_PRUNE_POLL_INTERVAL seconds.
+#
+# Set FHOST_PRUNE_DAEMON to True if you run the daemon, so uploads and changed
+# expiration dates within the horizon are passed on to it.  Otherwise, files
+# expiring soon after they are uploaded are only removed once they come into
+# the daemon's view on its own, which can take up to FHOST_PRUNE_HORIZON / 2.
+FHOST_PRUNE_HORIZON = timedelta(hours=1)
+FHOST_PRUNE_POLL_INTERVAL = 10
+FHOST_PRUNE_DAEMON = False
+
+
+# Resumable uploads that haven't received any data for this long are removed
+# by "flask prune", along with their partial data.  Temporary upload files
+# of that age left behind by crashed workers are removed as well.  The prune
+# daemon looks for them every FHOST_RESUMABLE_TTL / 2.
+FHOST_RESUMABLE_TTL = timedelta(days=1)
+
+
 # A list of IP addresses which are blacklisted from uploading files
 #
-# Can be set to the path of a file with an IP address on each line.  The file
-# can also include comment lines using a pound sign (#).  Paths are resolved
-# relative to the instance/ directory.
+# Can be set to the path of a file with an IP address or CIDR range (such as
+# 192.0.2.0/24 or 2001:db8::/32) on each line.  The file can also include
+# comment lines using a pound sign (#).  Paths are resolved relative to the
+# instance/ directory.
+#
+# The file is reloaded whenever it changes.  Lines appended to it, which is
+# what the moderation interface does when banning an IP, are picked up
+# without rereading the whole file.
 #
 # If this is set to None, then no IP blacklist will be consulted.
 FHOST_UPLOAD_BLACKLIST = None
 
+# IPv6 entries more specific than this prefix length are extended to it, so
+# banning one address of a host also covers the rest of its /64.  Set this
+# to None to match IPv6 entries exactly.
+FHOST_UPLOAD_BLACKLIST_V6_PREFIX = 64
+
+
+# Upload rate limits
+#
+# Each client address (or IPv6 network of FHOST_RATELIMIT_V6_PREFIX bits)
+# may upload FHOST_UPLOAD_RATE files and FHOST_UPLOAD_BYTE_RATE bytes per
+# second on average, with bursts of up to FHOST_UPLOAD_BURST files and
+# FHOST_UPLOAD_BYTE_BURST bytes.  Clients over their limit get a 429 response
+# with a Retry-After header.
+#
+# FHOST_UPLOAD_INFLIGHT_BYTES caps the total size of all uploads being
+# received at the same time; further uploads get a 503 response.
+#
+# Uploads are checked before they are received, going by their
+# Content-Length.  Uploads without one count as MAX_CONTENT_LENGTH bytes.
+#
+# The limits are shared by all 0x0 processes on this machine through an
+# SQLite database at FHOST_RATELIMIT_PATH (by default in the system's
+# temporary directory).  Set any of these to None to disable that limit.
+FHOST_RATELIMIT_PATH = None
+FHOST_RATELIMIT_V6_PREFIX = 64
+FHOST_UPLOAD_RATE = None            # e.g. 1 / 60
+FHOST_UPLOAD_BURST = 30
+FHOST_UPLOAD_BYTE_RATE = None       # e.g. 1024 * 1024
+FHOST_UPLOAD_BYTE_BURST = 1024 * 1024 * 1024
+FHOST_UPLOAD_INFLIGHT_BYTES = None  # e.g. 2 * 1024 * 1024 * 1024
+
+
+# Cache-Control headers sent with files
+#
+# Since the contents of a URL never change, files can be cached until they
+# expire.  {max_age} is replaced with the number of seconds until then.
+# FHOST_CACHE_CONTROL_SECRET is used for files uploaded with the "secret"
+# option, and FHOST_CACHE_CONTROL_NSFW for files detected as NSFW.  Set any of
+# these to None to not send the header.
+#
+# Files are also sent with an ETag based on their SHA-256 hash.  If you are
+# using X-Accel-Redirect with nginx, add
+#
+#   etag off;
+#   add_header ETag $upstream_http_etag;
+#
+# to the internal location for FHOST_STORAGE_PATH to use it instead of the one
+# nginx generates.
+FHOST_CACHE_CONTROL = "public, max-age={max_age}, immutable"
+FHOST_CACHE_CONTROL_SECRET = "private, max-age={max_age}, immutable"
+FHOST_CACHE_CONTROL_NSFW = "public, max-age={max_age}, immutable"
+
 
 # Enables support for detecting NSFW images
 #
@@ -179,6 +359,55 @@ NSFW_DETECT = False
 NSFW_THRESHOLD = 0.608
 
 
+# How many frames of a video to classify
+#
+# Only keyframes are decoded, so the time this takes mostly depends on the
+# number of samples, not on the length of the video.  The samples are spread
+# evenly over the video, and their scores are combined by taking either the
+# "max" or the "mean".
+NSFW_VIDEO_SAMPLES = 1
+NSFW_VIDEO_AGGREGATE = "max"
+
+
+# Score files for NSFW content in the background instead of during the upload
+#
+# Running the classifier takes a while, especially for videos, and uploads have
+# to wait for it to finish.  If this is set to True, files are stored without a
+# score and the nsfw-worker command fills it in later:
+#
+#   $ FLASK_APP=fhost flask nsfw-worker
+#
+# NSFW_WORKERS limits how many files are scored at once (None means one per CPU
+# core).  Files that fail to be scored are retried NSFW_RETRIES times, waiting
+# NSFW_RETRY_DELAY seconds in between.  When there is nothing to do, the worker
+# checks for new files every NSFW_POLL_INTERVAL seconds.
+#
+# If NSFW_DETECT is set to False, then this has no effect.
+NSFW_ASYNC = False
+NSFW_WORKERS = None
+NSFW_RETRIES = 3
+NSFW_RETRY_DELAY = 60
+NSFW_POLL_INTERVAL = 5
+
+
+# Share a single copy of the NSFW model between all workers
+#
+# Normally, every application worker loads its own copy of the model, which
+# takes up a lot of memory.  If this is set to the path of a unix socket, the
+# workers instead send frames to a server that has to be started with:
+#
+#   $ FLASK_APP=fhost flask nsfw-server
+#
+# Frames arriving within NSFW_BATCH_WAIT seconds of each other are classified
+# together, up to NSFW_BATCH_SIZE at a time.  Make sure the application workers
+# are allowed to connect to the socket.
+#
+# If NSFW_DETECT is set to False, then this has no effect.
+NSFW_SOCKET = None
+NSFW_BATCH_SIZE = 16
+NSFW_BATCH_WAIT = 0.01
+
+
 # If you want to scan files for viruses using ClamAV, specify the socket used
 # for connections here. You will need the clamd module.
 # Since this can take a very long time on larger files, it is not done
@@ -190,6 +419,16 @@ NSFW_THRESHOLD = 0.608
 # from clamd import ClamdUnixSocket
 # VSCAN_SOCKET = ClamdUnixSocket("/run/clamav/clamd-socket")
 
+# How files are handed to clamd.
+#
+# "instream" sends the contents over VSCAN_SOCKET and works with clamd
+# running anywhere.  If clamd runs on the same host and can read
+# FHOST_STORAGE_PATH, "scan" or "multiscan" let it open files by path, and
+# "fildes" passes it an open file descriptor over a unix socket, which
+# avoids copying every byte through 0x0.  Compressed files are always
+# streamed with "instream".
+VSCAN_MODE = "instream"
+
 # This is the directory that files flagged as malicious are moved to.
 # Relative paths are resolved relative to the working directory
 # of the 0x0 process.
@@ -199,9 +438,22 @@ VSCAN_QUARANTINE_PATH = "quarantine"
 # reported as clean, you may want to rescan old files periodically.
 # Set this to a datetime.timedelta to specify the frequency, or None to
 # disable rescanning.
+#
+# Files are only rescanned if clamd's signature database has been updated
+# since they were last scanned.
 from datetime import timedelta
 VSCAN_INTERVAL = timedelta(days=7)
 
+# Files whose MIME type starts with any of these are scanned before others
+# that have gone unscanned for the same amount of time.
+VSCAN_RISKY_MIME = [
+    "application/",
+    "image/svg+xml",
+    "text/html",
+    "text/javascript",
+    "text/x-",
+]
+
 # Some files flagged by ClamAV are usually not malicious, especially if the
 # DetectPUA option is enabled in clamd.conf. This is a list of signatures
 # that will be ignored.
@@ -210,6 +462,57 @@ VSCAN_IGNORE = [
     "PUA.Win.Packer.XmMusicFile",
 ]
 
+# Cache file metadata for downloads
+#
+# To serve a file, 0x0 needs to look up some information about it in the
+# database.  This is cached for up to FHOST_META_CACHE_TTL seconds for up to
+# FHOST_META_CACHE_SIZE files per worker, which helps a lot when a few files
+# are downloaded very often.  Set the size to 0 to disable the cache.
+#
+# Files removed by commands such as prune or vscan, by the moderation UI, or
+# by changing their expiration are noted in the database.  Every worker checks
+# for those at most every FHOST_META_CACHE_POLL_INTERVAL seconds and drops
+# them from its cache.  Expired and removed files are never cached, so a file
+# uploaded again after expiring is served correctly right away.
+#
+# When running under uWSGI, you can set FHOST_META_CACHE_SHARED to the name of
+# a uWSGI cache to share the entries between all workers.  If uWSGI metrics
+# are enabled, hits and misses are counted in the fhost.meta_cache.hits and
+# fhost.meta_cache.misses metrics.
+FHOST_META_CACHE_SIZE = 10000
+FHOST_META_CACHE_TTL = 60
+FHOST_META_CACHE_SHARED = None
+FHOST_META_CACHE_POLL_INTERVAL = 1
+
+
+# Cheaply reject requests for files and URLs that don't exist
+#
+# IDs that were looked up and not found are remembered for up to
+# FHOST_MISS_CACHE_TTL seconds, for up to FHOST_MISS_CACHE_SIZE IDs per worker.
+# The FHOST_MISS_CACHE_WINDOW IDs just below the highest one are never
+# remembered, since they may belong to uploads that are still being committed.
+#
+# Requests for IDs far beyond the highest one in the database (with at least
+# two more digits) are rejected without a lookup, as long as the highest ID
+# was queried within the last FHOST_MAX_ID_REFRESH seconds.  IDs just above it
+# cause it to be queried again, so new files from other workers are found.
+FHOST_MISS_CACHE_SIZE = 10000
+FHOST_MISS_CACHE_TTL = 3600
+FHOST_MISS_CACHE_WINDOW = 100
+FHOST_MAX_ID_REFRESH = 1
+
+
+# Cache shortened URLs
+#
+# Up to FHOST_REDIRECT_CACHE_SIZE shortened URLs per worker are kept in memory
+# for FHOST_REDIRECT_CACHE_TTL seconds.  If FHOST_REDIRECT_CACHE_CONTROL is
+# set, it is sent as the Cache-Control header of redirects, for example
+# "public, max-age=86400".
+FHOST_REDIRECT_CACHE_SIZE = 10000
+FHOST_REDIRECT_CACHE_TTL = 3600
+FHOST_REDIRECT_CACHE_CONTROL = None
+
+
 # A list of all characters which can appear in a URL
 #
 # If this list is too short, then URLs can very quickly become long.
@@ -0,0 +1,24 @@
+"""Record the signature database version files were scanned with
+
+Revision ID: 3f6a9d2e1c74
+Revises: e81b4f0c2a57
+Create Date: 2026-10-18 16:21:40.118305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f6a9d2e1c74'
+down_revision = 'e81b4f0c2a57'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('vscan_signatures', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_column('vscan_signatures')
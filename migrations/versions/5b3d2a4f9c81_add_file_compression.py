@@ -0,0 +1,24 @@
+"""Add compression method of stored files
+
+Revision ID: 5b3d2a4f9c81
+Revises: dd0766afb7d2
+Create Date: 2026-10-18 12:04:31.518337
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b3d2a4f9c81'
+down_revision = 'dd0766afb7d2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('compression', sa.String(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_column('compression')
@@ -0,0 +1,40 @@
+"""Add resumable upload sessions
+
+Revision ID: 7d2c5b8e4a19
+Revises: 3f6a9d2e1c74
+Create Date: 2026-10-18 18:42:05.630194
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d2c5b8e4a19'
+down_revision = '3f6a9d2e1c74'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('upload_session',
+    sa.Column('token', sa.String(), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('offset', sa.BigInteger(), nullable=True),
+    sa.Column('hash_state', sa.LargeBinary(), nullable=True),
+    sa.Column('filename', sa.UnicodeText(), nullable=True),
+    sa.Column('mime', sa.UnicodeText(), nullable=True),
+    sa.Column('expires', sa.BigInteger(), nullable=True),
+    sa.Column('secret', sa.Boolean(), nullable=True),
+    sa.Column('addr', sa.UnicodeText(), nullable=True),
+    sa.Column('ua', sa.UnicodeText(), nullable=True),
+    sa.Column('updated', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('token')
+    )
+    with op.batch_alter_table('upload_session', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_upload_session_updated'), ['updated'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('upload_session', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_upload_session_updated'))
+
+    op.drop_table('upload_session')
@@ -0,0 +1,70 @@
+"""Add indexed hash of shortened URLs
+
+Revision ID: a4c1e7d93b20
+Revises: 5b3d2a4f9c81
+Create Date: 2026-10-18 13:41:09.265214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4c1e7d93b20'
+down_revision = '5b3d2a4f9c81'
+
+from alembic import op
+import sqlalchemy as sa
+from hashlib import sha256
+
+
+def upgrade():
+    with op.batch_alter_table('URL', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('url_hash', sa.String(length=64), nullable=True))
+
+    url = sa.table('URL',
+                   sa.column('id', sa.Integer),
+                   sa.column('url', sa.UnicodeText),
+                   sa.column('url_hash', sa.String))
+    conn = op.get_bind()
+    last_id = 0
+
+    while True:
+        rows = conn.execute(sa.select(url.c.id, url.c.url)
+                            .where(url.c.id > last_id)
+                            .order_by(url.c.id)
+                            .limit(1000)).fetchall()
+
+        if not rows:
+            break
+
+        updates = [{ "_id" : r.id, "url_hash" : sha256(r.url.encode("utf-8")).hexdigest() }
+                   for r in rows if r.url is not None]
+
+        if updates:
+            conn.execute(url.update()
+                         .where(url.c.id == sa.bindparam("_id"))
+                         .values(url_hash=sa.bindparam("url_hash")),
+                         updates)
+
+        last_id = rows[-1].id
+
+    with op.batch_alter_table('URL', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_URL_url_hash'), ['url_hash'], unique=True)
+
+    # The unique index on url_hash replaces the one on the URLs themselves.
+    # The original constraint wasn't named, which SQLite keeps that way, so
+    # give it a name to be able to drop it there.
+    name = None
+    for uc in sa.inspect(conn).get_unique_constraints('URL'):
+        if uc['column_names'] == ['url']:
+            name = uc['name'] or 'uq_URL_url'
+
+    if name:
+        with op.batch_alter_table('URL', schema=None, naming_convention={
+                "uq" : "uq_%(table_name)s_%(column_0_name)s" }) as batch_op:
+            batch_op.drop_constraint(name, type_='unique')
+
+
+def downgrade():
+    with op.batch_alter_table('URL', schema=None) as batch_op:
+        batch_op.create_unique_constraint('URL_url_key', ['url'])
+        batch_op.drop_index(batch_op.f('ix_URL_url_hash'))
+        batch_op.drop_column('url_hash')
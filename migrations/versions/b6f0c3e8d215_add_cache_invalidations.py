@@ -0,0 +1,33 @@
+"""Add cache invalidations shared between processes
+
+Revision ID: b6f0c3e8d215
+Revises: 7d2c5b8e4a19
+Create Date: 2026-10-18 21:17:44.318259
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b6f0c3e8d215'
+down_revision = '7d2c5b8e4a19'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('cache_invalidation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('file_id', sa.Integer(), nullable=True),
+    sa.Column('created', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=True
+    )
+    with op.batch_alter_table('cache_invalidation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_cache_invalidation_created'), ['created'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('cache_invalidation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_cache_invalidation_created'))
+
+    op.drop_table('cache_invalidation')
@@ -0,0 +1,24 @@
+"""Index file expiration
+
+Revision ID: c9e2f51a7d36
+Revises: a4c1e7d93b20
+Create Date: 2026-10-18 14:22:51.804470
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c9e2f51a7d36'
+down_revision = 'a4c1e7d93b20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_file_expiration'), ['expiration'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_file_expiration'))
@@ -0,0 +1,26 @@
+"""Add expiry notifications for the prune daemon
+
+Revision ID: e81b4f0c2a57
+Revises: c9e2f51a7d36
+Create Date: 2026-10-18 15:03:12.447021
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e81b4f0c2a57'
+down_revision = 'c9e2f51a7d36'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('expiry_event',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('file_id', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('expiry_event')
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from itertools import zip_longest
+import io
 from sys import stdout
 import time
 
@@ -12,7 +13,7 @@ from textual import log
 from rich.text import Text
 from jinja2.filters import do_filesizeformat
 
-from fhost import db, File, su, app as fhost_app, in_upload_bl
+from fhost import db, File, su, app as fhost_app, in_upload_bl, get_upload_blocklist
 from modui import *
 
 fhost_app.app_context().push()
@@ -95,8 +96,7 @@ class NullptrMod(Screen):
                 if in_upload_bl(self.current_file.addr):
                     txt = f"{self.current_file.addr} is already banned"
                 else:
-                    with fhost_app.open_instance_resource(fhost_app.config["FHOST_UPLOAD_BLACKLIST"], "a") as bl:
-                        print(self.current_file.addr.lstrip("::ffff:"), file=bl)
+                    get_upload_blocklist().add(self.current_file.addr)
                     txt = f"Banned {self.current_file.addr}"
 
                 if nuke:
@@ -160,7 +160,7 @@ class NullptrMod(Screen):
         return True
 
     def handle_text(self, cat):
-        with open(self.current_file.getpath(), "r") as sf:
+        with io.TextIOWrapper(self.current_file.open()) as sf:
             data = sf.read(1000000).replace("\033","")
             self.ftlog.write(data)
         return True
@@ -232,7 +232,7 @@ class NullptrMod(Screen):
                                     for c in map(lambda x: bytes([n for n in x if n != None]),
                                                 zip_longest(*[iter(binf.read(min(length, 16 * 10)))] * 16))))
 
-        with open(self.current_file.getpath(), "rb") as binf:
+        with self.current_file.open() as binf:
             self.ftlog.write(hexdump(binf, self.current_file.size))
             if self.current_file.size > 16*10*2:
                 binf.seek(self.current_file.size-16*10)
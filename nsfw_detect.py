@@ -20,8 +20,13 @@
 
 import numpy as np
 import os
+import queue
+import socket
+import socketserver
+import struct
 import sys
-from io import BytesIO
+import threading
+import time
 from pathlib import Path
 
 os.environ["GLOG_minloglevel"] = "2"  # seriously :|
@@ -30,53 +35,89 @@ import av
 av.logging.set_level(av.logging.PANIC)
 
 class NSFWDetector:
-    def __init__(self):
+    """
+    If socket is given, the model is not loaded. Instead, frames are sent to
+    an NSFWServer listening on that path for classification.
+
+    For videos, samples keyframes spread evenly over the duration are scored
+    and their scores combined using aggregate, which is "max" or "mean".
+    """
+    def __init__(self, socket=None, samples=1, aggregate="max"):
+        self.socket = socket
+        self.samples = samples
+        self.aggregate = { "max" : max, "mean" : np.mean }[aggregate]
+
+        if socket:
+            return
+
         npath = Path(__file__).parent / "nsfw_model"
         self.nsfw_net = caffe.Net(
             str(npath / "deploy.prototxt"),
             caffe.TEST,
             weights = str(npath / "resnet_50_1by2_nsfw.caffemodel")
         )
-        self.caffe_transformer = caffe.io.Transformer({
-            'data': self.nsfw_net.blobs['data'].data.shape
-        })
-        # move image channels to outermost
-        self.caffe_transformer.set_transpose('data', (2, 0, 1))
-        # subtract the dataset-mean value in each channel
-        self.caffe_transformer.set_mean('data', np.array([104, 117, 123]))
-        # rescale from [0, 1] to [0, 255]
-        self.caffe_transformer.set_raw_scale('data', 255)
-        # swap channels from RGB to BGR
-        self.caffe_transformer.set_channel_swap('data', (2, 1, 0))
-
-    def _compute(self, img):
-        image = caffe.io.load_image(img)
+        # per-channel dataset mean, in BGR order like the network input
+        self.mean = np.array([104, 117, 123], dtype=np.float32)[:, np.newaxis, np.newaxis]
+
+    """
+    Writes the network input for an RGB image (as a HxWx3 uint8 array) to out.
 
+    The image is center-cropped to the input size without copying, then
+    transposed, converted to BGR and mean-subtracted in a single pass.
+    """
+    def _preprocess(self, image, out):
+        c, h, w = out.shape
         H, W, _ = image.shape
-        _, _, h, w = self.nsfw_net.blobs["data"].data.shape
         h_off = int(max((H - h) / 2, 0))
         w_off = int(max((W - w) / 2, 0))
         crop = image[h_off:h_off + h, w_off:w_off + w, :]
 
-        transformed_image = self.caffe_transformer.preprocess('data', crop)
-        transformed_image.shape = (1,) + transformed_image.shape
+        if crop.shape[:2] != (h, w):
+            # image smaller than the input size, stretch it like caffe does
+            crop = caffe.io.resize_image(crop / 255, (h, w)) * 255
+
+        np.subtract(crop[:, :, ::-1].transpose(2, 0, 1), self.mean,
+                    out=out, casting="unsafe")
+
+    def _compute_batch(self, imgs):
+        _, c, h, w = self.nsfw_net.blobs["data"].data.shape
+        batch = np.empty((len(imgs), c, h, w), dtype=np.float32)
+
+        for i, img in enumerate(imgs):
+            self._preprocess(img, batch[i])
+
+        self.nsfw_net.blobs["data"].reshape(*batch.shape)
+        self.nsfw_net.reshape()
 
         input_name = self.nsfw_net.inputs[0]
         output_layers = ["prob"]
         all_outputs = self.nsfw_net.forward_all(
-            blobs=output_layers, **{input_name: transformed_image})
+            blobs=output_layers, **{input_name: batch})
 
-        outputs = all_outputs[output_layers[0]][0].astype(float)
+        outputs = all_outputs[output_layers[0]].astype(float)
 
         return outputs
 
-    def detect(self, fpath):
-        try:
-            with av.open(fpath) as container:
-                try: container.seek(int(container.duration / 2))
+    def _frames(self, fpath):
+        frames = []
+
+        with av.open(fpath) as container:
+            stream = container.streams.video[0]
+            # only keyframes are needed, which can be decoded independently
+            stream.thread_type = "AUTO"
+            stream.codec_context.skip_frame = "NONKEY"
+
+            if container.duration:
+                offsets = [int(container.duration * (i + 1) / (self.samples + 1))
+                           for i in range(self.samples)]
+            else:
+                offsets = [0]
+
+            for offset in offsets:
+                try: container.seek(offset)
                 except: container.seek(0)
 
-                frame = next(container.decode(video=0))
+                frame = next(container.decode(stream))
 
                 if frame.width >= frame.height:
                     w = 256
@@ -84,20 +125,166 @@ class NSFWDetector:
                 else:
                     w = int(frame.width * (256 / frame.height))
                     h = 256
-                frame = frame.reformat(width=w, height=h, format="rgb24")
-                img = BytesIO()
-                frame.to_image().save(img, format="ppm")
 
-            scores = self._compute(img)
+                frames.append(frame.to_ndarray(width=w, height=h, format="rgb24"))
+
+        return frames
+
+    def _remote(self, img):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(self.socket)
+            s.sendall(struct.pack("!III", *img.shape))
+            s.sendall(np.ascontiguousarray(img, dtype=np.uint8).data)
+
+            with s.makefile("rb") as r:
+                score, = struct.unpack("!d", r.read(8))
+
+        return score
+
+    def detect(self, fpath):
+        try:
+            frames = self._frames(fpath)
+
+            if self.socket:
+                scores = [self._remote(img) for img in frames]
+            else:
+                scores = self._compute_batch(frames)[:, 1]
         except:
             return -1.0
 
-        return scores[1]
+        return float(self.aggregate(scores))
+
+
+class _NSFWRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            shape = struct.unpack("!III", self.rfile.read(12))
+            data = self.rfile.read(shape[0] * shape[1] * shape[2])
+            score = self.server.submit(np.frombuffer(data, dtype=np.uint8).reshape(shape))
+        except:
+            score = -1.0
+
+        self.wfile.write(struct.pack("!d", score))
+
+
+class NSFWServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves a single NSFWDetector to any number of clients over a unix socket.
+
+    Frames that arrive within batch_wait seconds of each other are classified
+    together, up to batch_size at a time.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, batch_size=16, batch_wait=0.01):
+        self.detector = NSFWDetector()
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue()
+
+        Path(path).unlink(missing_ok=True)
+        super().__init__(path, _NSFWRequestHandler)
+
+        threading.Thread(target=self._batcher, daemon=True).start()
+
+    def submit(self, img):
+        job = { "img" : img, "score" : -1.0, "done" : threading.Event() }
+        self.queue.put(job)
+        job["done"].wait()
+        return job["score"]
+
+    def _batcher(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                scores = self.detector._compute_batch([j["img"] for j in batch])
+                for j, s in zip(batch, scores):
+                    j["score"] = s[1]
+            except:
+                pass
+
+            for j in batch:
+                j["done"].set()
+
+
+"""
+Compares the time it takes to prepare the network input for each file in a
+directory, passing frames as arrays versus the previous PPM round-trip.
+"""
+def benchmark(n, directory):
+    from io import BytesIO
+
+    transformer = caffe.io.Transformer({
+        'data': n.nsfw_net.blobs['data'].data.shape
+    })
+    transformer.set_transpose('data', (2, 0, 1))
+    transformer.set_mean('data', np.array([104, 117, 123]))
+    transformer.set_raw_scale('data', 255)
+    transformer.set_channel_swap('data', (2, 1, 0))
+
+    def ppm(fpath):
+        with av.open(fpath) as container:
+            try: container.seek(int(container.duration / 2))
+            except: container.seek(0)
+
+            frame = next(container.decode(video=0))
+
+            if frame.width >= frame.height:
+                w = 256
+                h = int(frame.height * (256 / frame.width))
+            else:
+                w = int(frame.width * (256 / frame.height))
+                h = 256
+            frame = frame.reformat(width=w, height=h, format="rgb24")
+            buf = BytesIO()
+            frame.to_image().save(buf, format="ppm")
+
+        buf.seek(0)
+        image = caffe.io.load_image(buf)
+
+        _, _, h, w = n.nsfw_net.blobs["data"].data.shape
+        H, W, _ = image.shape
+        h_off = int(max((H - h) / 2, 0))
+        w_off = int(max((W - w) / 2, 0))
+        return transformer.preprocess('data', image[h_off:h_off + h, w_off:w_off + w, :])
+
+    def direct(fpath):
+        out = np.empty(n.nsfw_net.blobs["data"].data.shape[1:], dtype=np.float32)
+        n._preprocess(n._frames(fpath)[0], out)
+        return out
+
+    files = [str(p) for p in sorted(Path(directory).iterdir()) if p.is_file()]
+
+    for name, fn in (("ppm", ppm), ("direct", direct)):
+        count = 0
+        start = time.perf_counter()
+        for f in files:
+            try:
+                fn(f)
+                count += 1
+            except:
+                pass
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {count} files, {elapsed * 1000 / max(count, 1):.2f} ms/file")
 
 
 if __name__ == "__main__":
     n = NSFWDetector()
 
-    for inf in sys.argv[1:]:
-        score = n.detect(inf)
-        print(inf, score)
+    if len(sys.argv) == 3 and sys.argv[1] == "--benchmark":
+        benchmark(n, sys.argv[2])
+    else:
+        for inf in sys.argv[1:]:
+            score = n.detect(inf)
+            print(inf, score)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+    Copyright © 2020 Mia Herkt
+    Licensed under the EUPL, Version 1.2 or - as soon as approved
+    by the European Commission - subsequent versions of the EUPL
+    (the "License");
+    You may not use this work except in compliance with the License.
+    You may obtain a copy of the license at:
+
+        https://joinup.ec.europa.eu/software/page/eupl
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+    either express or implied.
+    See the License for the specific language governing permissions
+    and limitations under the License.
+"""
+
+import ipaddress
+import os
+import sqlite3
+import threading
+import time
+import typing
+from pathlib import Path
+
+from blocklist import parse_address
+
+"""
+Returns the key clients are rate limited by: their address, or for IPv6 the
+network of v6_prefix bits it belongs to.
+"""
+def client_key(addr: str, v6_prefix: int = 64) -> str:
+    try:
+        ip = parse_address(addr)
+    except ValueError:
+        return addr
+
+    if ip.version == 6 and v6_prefix is not None:
+        return str(ipaddress.ip_network(f"{ip}/{v6_prefix}", strict=False))
+
+    return str(ip)
+
+class RateLimiter:
+    """
+    Token buckets and a budget of in-flight bytes, kept in an SQLite
+    database so that all processes on a machine share them.
+
+    A bucket holds up to burst tokens and gains rate tokens per second.
+    Buckets that would be full again are forgotten.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = threading.local()
+
+    def _db(self) -> sqlite3.Connection:
+        # Connections must not be shared with forked children
+        if getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS bucket (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    full_at REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS ix_bucket_full_at ON bucket (full_at);
+                CREATE TABLE IF NOT EXISTS inflight (
+                    id INTEGER PRIMARY KEY,
+                    bytes INTEGER NOT NULL,
+                    expires REAL NOT NULL);
+            """)
+            self._local.db = db
+            self._local.pid = os.getpid()
+
+        return self._local.db
+
+    def take(self, buckets: typing.List[typing.Tuple[str, float, float, float]]) -> float:
+        """
+        Takes cost tokens from each of the given (key, cost, rate, burst)
+        buckets, but only if all of them have enough.
+
+        Returns 0 on success, or else the number of seconds until there
+        would be enough tokens.
+        """
+        db = self._db()
+        now = time.time()
+        wait = 0
+        update = []
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM bucket WHERE full_at < ?", (now,))
+
+            for key, cost, rate, burst in buckets:
+                # Anything larger than the bucket could never be let through
+                cost = min(cost, burst)
+
+                row = db.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+
+                if tokens < cost:
+                    wait = max(wait, (cost - tokens) / rate)
+
+                update.append((key, tokens - cost, now, now + (burst - tokens + cost) / rate))
+
+            if not wait:
+                db.executemany("INSERT OR REPLACE INTO bucket VALUES (?, ?, ?, ?)", update)
+
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def reserve(self, nbytes: int, limit: int, ttl: float = 3600) -> typing.Optional[int]:
+        """
+        Reserves nbytes of a global budget of limit bytes, for at most ttl
+        seconds in case the reservation is never released.
+
+        Returns the reservation id, or None if the budget is exhausted.
+        """
+        db = self._db()
+        now = time.time()
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM inflight WHERE expires < ?", (now,))
+            used = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM inflight").fetchone()[0]
+
+            # A single request larger than the budget is let through alone
+            if used and used + nbytes > limit:
+                rid = None
+            else:
+                rid = db.execute("INSERT INTO inflight (bytes, expires) VALUES (?, ?)",
+                                 (nbytes, now + ttl)).lastrowid
+
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+        return rid
+
+    def release(self, rid: int):
+        self._db().execute("DELETE FROM inflight WHERE id = ?", (rid,))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""
+    Copyright © 2020 Mia Herkt
+    Licensed under the EUPL, Version 1.2 or - as soon as approved
+    by the European Commission - subsequent versions of the EUPL
+    (the "License");
+    You may not use this work except in compliance with the License.
+    You may obtain a copy of the license at:
+
+        https://joinup.ec.europa.eu/software/page/eupl
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+    either express or implied.
+    See the License for the specific language governing permissions
+    and limitations under the License.
+"""
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+def is_digest(name: str) -> bool:
+    if len(name) != 64:
+        return False
+
+    try:
+        int(name, 16)
+    except ValueError:
+        return False
+
+    return True
+
+"""
+Opens a stored object for reading, transparently decompressing it if it was
+stored with compression ("gzip" or "zstd").
+"""
+def open_object(path: Path, compression: str = None):
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+    return open(path, "rb")
+
+"""
+Compresses the contents of src into the binary file object dst.
+"""
+def compress(src, dst, compression: str, chunk_size: int = io.DEFAULT_BUFFER_SIZE):
+    if compression == "zstd":
+        import zstandard
+        cf = zstandard.ZstdCompressor().stream_writer(dst, closefd=False)
+    else:
+        cf = gzip.GzipFile(filename="", fileobj=dst, mode="wb", mtime=0)
+
+    with cf:
+        shutil.copyfileobj(src, cf, chunk_size)
+
+class LocalStorage:
+    """
+    Stores objects in a local directory, named after their SHA-256 digest.
+
+    With shard_depth set, objects are spread over that many levels of
+    subdirectories named after pairs of hex digits of the digest, e.g.
+    ab/cd/abcd... for a depth of 2.  Objects still stored directly in the
+    root directory are found as well.
+    """
+    def __init__(self, root, shard_depth=0):
+        self.root = Path(root)
+        self.shard_depth = shard_depth
+
+    @property
+    def tiers(self):
+        return [self]
+
+    @property
+    def tmpdir(self) -> Path:
+        return self.root
+
+    def _path(self, digest: str, flat: bool = False) -> Path:
+        if flat:
+            return self.root / digest
+
+        return self.root.joinpath(*(digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)), digest)
+
+    def path(self, digest: str) -> Path:
+        p = self._path(digest)
+
+        if self.shard_depth and not p.is_file():
+            # The store might not have been fully migrated to sharding yet
+            flat = self._path(digest, flat=True)
+            if flat.is_file():
+                return flat
+
+        return p
+
+    def exists(self, digest: str) -> bool:
+        return self.path(digest).is_file()
+
+    def put(self, tmp: Path, digest: str) -> Path:
+        p = self.path(digest)
+
+        if not p.is_file():
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp.rename(p)
+
+        return p
+
+    def delete(self, digest: str) -> bool:
+        try:
+            self.path(digest).unlink()
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def accessed(self, digest: str):
+        pass
+
+    def objects(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if is_digest(name):
+                    yield name, Path(dirpath) / name
+
+    def unsharded(self):
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if is_digest(entry.name) and entry.is_file(follow_symlinks=False):
+                    yield entry.name
+
+    def shard(self, digest: str):
+        dest = self._path(digest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(self._path(digest, flat=True), dest)
+
+    def receive(self, src: Path, digest: str):
+        """
+        Moves an object from another directory, which may be on a different
+        file system, into this one without ever exposing a partial copy.
+        """
+        dest = self._path(digest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".move-")
+        os.close(fd)
+
+        try:
+            # Reading the file updates its access time, so keep the original
+            st = src.stat()
+            shutil.copyfile(src, tmp)
+            shutil.copymode(src, tmp)
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.rename(tmp, dest)
+        except:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+        src.unlink()
+
+class TieredStorage:
+    """
+    Keeps new and recently downloaded objects on a fast tier and everything
+    else on a large, slow tier.
+
+    Downloads update the access time of an object, at most once every
+    touch_interval seconds, which is what decides which tier it belongs on.
+    """
+    def __init__(self, hot: LocalStorage, cold: LocalStorage, touch_interval=3600):
+        self.hot = hot
+        self.cold = cold
+        self.touch_interval = touch_interval
+
+    @property
+    def tiers(self):
+        return [self.hot, self.cold]
+
+    @property
+    def tmpdir(self) -> Path:
+        return self.hot.tmpdir
+
+    def path(self, digest: str) -> Path:
+        p = self.hot.path(digest)
+
+        if not p.is_file():
+            c = self.cold.path(digest)
+            if c.is_file():
+                return c
+
+        return p
+
+    def exists(self, digest: str) -> bool:
+        return self.path(digest).is_file()
+
+    def put(self, tmp: Path, digest: str) -> Path:
+        if self.cold.exists(digest):
+            return self.cold.path(digest)
+
+        return self.hot.put(tmp, digest)
+
+    def delete(self, digest: str) -> bool:
+        removed = self.hot.delete(digest)
+        return self.cold.delete(digest) or removed
+
+    def accessed(self, digest: str):
+        try:
+            p = self.path(digest)
+            st = p.stat()
+            now = time.time()
+
+            if now - st.st_atime > self.touch_interval:
+                os.utime(p, (now, st.st_mtime))
+        except OSError:
+            pass
+
+    def demote(self, digest: str):
+        self.cold.receive(self.hot.path(digest), digest)
+
+    def promote(self, digest: str):
+        self.hot.receive(self.cold.path(digest), digest)
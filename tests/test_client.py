@@ -1,10 +1,15 @@
 import pytest
 import tempfile
+import gzip
 import os
-from flask_migrate import upgrade as db_upgrade
+import time
+import datetime
+from flask_migrate import upgrade as db_upgrade, downgrade as db_downgrade
 from io import BytesIO
+from pathlib import Path
 
-from fhost import app, db, url_for, File, URL
+import fhost
+from fhost import app, db, url_for, File, URL, meta_cache, miss_cache, redirect_cache
 
 @pytest.fixture
 def client():
@@ -16,6 +21,9 @@ def client():
         with app.test_client() as client:
             with app.app_context():
                 db_upgrade()
+            meta_cache.clear()
+            miss_cache.clear()
+            redirect_cache.clear()
             yield client
 
 def test_client(client):
@@ -79,3 +87,1086 @@ def test_client(client):
             rv = client.get(p)
             assert rv.status_code == code
 
+
+def test_upload_spooling(client):
+    data = os.urandom(3 * app.config["FHOST_CHUNK_SIZE"] + 17)
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(data), "random.bin") })
+    assert rv.status_code == 200
+
+    f = File.query.get(1)
+    assert f.size == len(data)
+    assert f.getpath().read_bytes() == data
+
+    # no temporary files are left behind
+    assert os.listdir(app.config["FHOST_STORAGE_PATH"]) == [f.sha256]
+
+def test_storage_sharding(client, monkeypatch):
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"flat"), "flat.txt") })
+    assert rv.status_code == 200
+
+    f = File.query.get(1)
+    storage = app.config["FHOST_STORAGE_PATH"]
+    assert f.getpath() == Path(storage) / f.sha256
+
+    monkeypatch.setitem(app.config, "FHOST_STORAGE_SHARD_DEPTH", 2)
+
+    # files are found in the old location until they are migrated
+    assert f.getpath() == Path(storage) / f.sha256
+    assert client.get("E.txt").status_code == 200
+
+    result = app.test_cli_runner().invoke(args=["shard-storage"])
+    assert result.exit_code == 0
+
+    sharded = Path(storage) / f.sha256[:2] / f.sha256[2:4] / f.sha256
+    assert sharded.is_file()
+    assert f.getpath() == sharded
+
+    rv = client.get("E.txt")
+    assert rv.status_code == 200
+    assert rv.headers["X-Accel-Redirect"] == "/" + str(sharded)
+
+    # files removed while migrating are skipped
+    monkeypatch.setitem(app.config, "FHOST_STORAGE_SHARD_DEPTH", 0)
+    for data in (b"gone", b"kept"):
+        rv = client.post("/", buffered=True,
+                         content_type="multipart/form-data",
+                         data={ "file" : (BytesIO(data), "flat.txt") })
+        assert rv.status_code == 200
+
+    gone, kept = File.query.get(2), File.query.get(3)
+    monkeypatch.setitem(app.config, "FHOST_STORAGE_SHARD_DEPTH", 2)
+
+    unsharded = fhost.LocalStorage.unsharded
+    def unsharded_then_prune(self):
+        for digest in unsharded(self):
+            if digest == gone.sha256:
+                (Path(storage) / digest).unlink()
+            yield digest
+
+    monkeypatch.setattr(fhost.LocalStorage, "unsharded", unsharded_then_prune)
+    result = app.test_cli_runner().invoke(args=["shard-storage"])
+    assert result.exit_code == 0
+    assert "1 file(s) moved" in result.output
+    assert kept.getpath() == Path(storage) / kept.sha256[:2] / kept.sha256[2:4] / kept.sha256
+    assert kept.getpath().is_file()
+
+def test_tiered_storage(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, "FHOST_STORAGE_BACKEND", "tiered")
+    monkeypatch.setitem(app.config, "FHOST_STORAGE_COLD_PATH", str(tmp_path / "cold"))
+    monkeypatch.setitem(app.config, "FHOST_TIER_MIN_SIZE", 0)
+
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"tiered"), "tiered.txt") })
+    assert rv.status_code == 200
+
+    f = File.query.get(1)
+    hot = Path(app.config["FHOST_STORAGE_PATH"]) / f.sha256
+    cold = tmp_path / "cold" / f.sha256
+    assert f.getpath() == hot
+
+    # not downloaded in a long time
+    old = time.time() - 30 * 24 * 60 * 60
+    os.utime(hot, (old, old))
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=["tier"]).exit_code == 0
+    assert not hot.exists()
+    assert f.getpath() == cold
+
+    rv = client.get("E.txt")
+    assert rv.status_code == 200
+    assert rv.headers["X-Accel-Redirect"] == "/" + str(cold)
+
+    # the download makes it hot again
+    assert runner.invoke(args=["tier"]).exit_code == 0
+    assert f.getpath() == hot
+    assert hot.read_bytes() == b"tiered"
+
+def test_compression(client, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_COMPRESSION", "gzip")
+    monkeypatch.setitem(app.config, "FHOST_USE_X_ACCEL_REDIRECT", False)
+
+    data = b"all work and no play makes jack a dull boy\n" * 1000
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(data), "jack.txt") })
+    assert rv.status_code == 200
+
+    f = File.query.get(1)
+    assert f.compression == "gzip"
+    assert f.size == len(data)
+    assert f.getpath().stat().st_size < len(data)
+    assert gzip.decompress(f.getpath().read_bytes()) == data
+
+    rv = client.get("E.txt", headers={ "Accept-Encoding" : "gzip" })
+    assert rv.status_code == 200
+    assert rv.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(rv.data) == data
+
+    rv = client.get("E.txt")
+    assert rv.status_code == 200
+    assert "Content-Encoding" not in rv.headers
+    assert rv.data == data
+
+    # incompressible data is stored as-is
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"short"), "short.txt") })
+    assert File.query.get(2).compression is None
+
+def test_conditional_get(client, monkeypatch):
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"cache me"), "cache.txt") })
+    assert rv.status_code == 200
+
+    f = File.query.get(1)
+
+    for xaccel in (True, False):
+        monkeypatch.setitem(app.config, "FHOST_USE_X_ACCEL_REDIRECT", xaccel)
+
+        rv = client.get("E.txt")
+        assert rv.status_code == 200
+        assert rv.headers["ETag"] == f'"{f.sha256}"'
+        assert rv.headers["Cache-Control"].startswith("public, max-age=")
+        assert int(rv.headers["Cache-Control"].split("=")[1].split(",")[0]) > 0
+
+        rv = client.get("E.txt", headers={ "If-None-Match" : f'"{f.sha256}"' })
+        assert rv.status_code == 304
+        assert not rv.data
+
+    # conditional requests are answered without looking at the file
+    f.getpath().unlink()
+    rv = client.get("E.txt", headers={ "If-None-Match" : f'"{f.sha256}"' })
+    assert rv.status_code == 304
+    assert client.get("E.txt").status_code == 404
+
+def test_range_requests(client, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_USE_X_ACCEL_REDIRECT", False)
+
+    data = bytes(range(256)) * 4
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(data), "range.bin") })
+    assert rv.status_code == 200
+
+    f = File.query.get(1)
+
+    rv = client.get("E.bin")
+    assert rv.status_code == 200
+    assert rv.headers["Accept-Ranges"] == "bytes"
+    assert rv.data == data
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=10-19" })
+    assert rv.status_code == 206
+    assert rv.headers["Content-Range"] == f"bytes 10-19/{len(data)}"
+    assert rv.data == data[10:20]
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=1000-" })
+    assert rv.status_code == 206
+    assert rv.data == data[1000:]
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=-5" })
+    assert rv.status_code == 206
+    assert rv.data == data[-5:]
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=0-1,100-101" })
+    assert rv.status_code == 206
+    assert rv.mimetype == "multipart/byteranges"
+    assert int(rv.headers["Content-Length"]) == len(rv.data)
+    assert b"\r\n\r\n" + data[0:2] + b"\r\n" in rv.data
+    assert b"\r\n\r\n" + data[100:102] + b"\r\n" in rv.data
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=5000-" })
+    assert rv.status_code == 416
+    assert rv.headers["Content-Range"] == f"bytes */{len(data)}"
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=10-19",
+                                       "If-Range" : f'"{f.sha256}"' })
+    assert rv.status_code == 206
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=10-19",
+                                       "If-Range" : '"outdated"' })
+    assert rv.status_code == 200
+    assert rv.data == data
+
+    # Like uWSGI's, this file wrapper sends the file from the beginning
+    # regardless of its position, so it must only be used for whole files
+    wrapped = []
+
+    def file_wrapper(fo, block_size=8192):
+        wrapped.append(fo)
+        fo.seek(0)
+        return iter(lambda: fo.read(block_size), b"")
+
+    env = { "wsgi.file_wrapper" : file_wrapper }
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=1000-" }, environ_base=env)
+    assert rv.status_code == 206
+    assert rv.data == data[1000:]
+    assert not wrapped
+
+    rv = client.get("E.bin", headers={ "Range" : "bytes=0-" }, environ_base=env)
+    assert rv.data == data
+    assert len(wrapped) == 1
+
+def test_meta_cache(client):
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"hot file"), "hot.txt") })
+    assert rv.status_code == 200
+    token = rv.headers["X-Token"]
+
+    hits, misses = meta_cache.hits, meta_cache.misses
+    assert client.get("E.txt").status_code == 200
+    assert client.get("E.txt").status_code == 200
+    assert meta_cache.misses == misses + 1
+    assert meta_cache.hits == hits + 1
+
+    # changing the expiration invalidates the cached record
+    rv = client.post("E.txt", data={ "token" : token, "expires" : 1 })
+    assert rv.status_code == 202
+
+    expiration = File.query.get(1).expiration
+    assert client.get("E.txt").headers["X-Expires"] == str(expiration)
+
+    # expired files aren't cached, so another worker uploading the file again
+    # with a secret doesn't leave a stale public record behind
+    f = File.query.get(1)
+    f.expiration = None
+    db.session.commit()
+    meta_cache.clear()
+    client.get("E.txt")
+    assert meta_cache.get(1) is None
+
+    f = File.query.get(1)
+    f.expiration = expiration
+    f.secret = "sesame"
+    db.session.commit()
+    assert client.get("E.txt").status_code == 404
+    assert client.get("s/sesame/E.txt").status_code == 200
+
+def test_meta_cache_invalidation(client, monkeypatch):
+    monkeypatch.setattr(fhost, "_last_invalidation", None)
+    monkeypatch.setattr(fhost, "_next_invalidation_poll", 0)
+    monkeypatch.setitem(app.config, "FHOST_META_CACHE_POLL_INTERVAL", 0)
+
+    for i in range(2):
+        rv = client.post("/", buffered=True,
+                         content_type="multipart/form-data",
+                         data={ "file" : (BytesIO(b"cached %d" % i), "c.txt") })
+        assert rv.status_code == 200
+
+    assert client.get("E.txt").status_code == 200
+    assert client.get("Q.txt").status_code == 200
+    stale = meta_cache.get(1)
+    assert stale
+
+    # workers find out about files removed by commands
+    f = File.query.get(1)
+    f.expiration = 1000
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["prune"])
+    assert result.exit_code == 0
+    assert fhost.CacheInvalidation.query.count() == 1
+
+    meta_cache.set(1, stale)
+    assert client.get("E.txt").status_code == 404
+    assert meta_cache.get(1) is None
+    assert meta_cache.get(2)
+
+    # old invalidations are cleaned up, but their IDs aren't reused
+    inv = fhost.CacheInvalidation.query.get(1)
+    inv.created -= datetime.timedelta(seconds=app.config["FHOST_META_CACHE_TTL"] + 1)
+    db.session.commit()
+
+    fhost.invalidate_meta([1])
+    db.session.commit()
+    assert [i.id for i in fhost.CacheInvalidation.query] == [2]
+
+    assert client.get("E.txt").status_code == 404
+    meta_cache.set(2, meta_cache.get(2)._replace(secret="stale"))
+    assert client.get("Q.txt").status_code == 404
+
+    db.session.add(fhost.CacheInvalidation(2))
+    db.session.commit()
+    assert client.get("Q.txt").status_code == 200
+
+def test_reject_invalid(client):
+    for p in ["wp-login.php", "a!b.txt", "<script>.txt", ".env", "%00.txt"]:
+        rv = client.get(p)
+        assert rv.status_code == 404
+
+    rv = client.get("<b>.txt")
+    assert b"<b>" not in rv.data
+
+    # IDs beyond the highest one are rejected until a file gets that ID
+    assert client.get("E.txt").status_code == 404
+
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"new"), "new.txt") })
+    assert rv.status_code == 200
+    assert client.get("E.txt").status_code == 200
+
+    # Files uploaded by other workers are found right away
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"elsewhere"), "new.txt") })
+    name = fhost.su.enbase(2)
+    fhost._max_ids[File] = (1, time.monotonic())
+    assert client.get(f"{name}.txt").status_code == 200
+
+    # but IDs much higher than any existing one are rejected without a lookup
+    assert fhost.beyond_max_id(File, 64 ** 3)
+
+    # Misses just below the highest ID aren't remembered, as those might
+    # still be committed
+    fhost._max_ids[File] = (500, time.monotonic())
+    for id, remembered in ((400, True), (450, False)):
+        assert client.get(f"{fhost.su.enbase(id)}.txt").status_code == 404
+        assert bool(miss_cache.get((File, id))) == remembered
+
+def test_url_hash(client):
+    with app.app_context():
+        db_downgrade(revision="5b3d2a4f9c81")
+        db.session.execute(db.text("INSERT INTO URL (url) VALUES ('https://example.com')"))
+        db.session.commit()
+        db_upgrade()
+
+    u = URL.query.get(1)
+    assert u.url_hash == URL.hash("https://example.com")
+
+    # only the hash is indexed
+    insp = db.inspect(db.engine)
+    assert not insp.get_unique_constraints("URL")
+    assert [i["column_names"] for i in insp.get_indexes("URL")] == [["url_hash"]]
+
+    rv = client.post("/", data={ "shorten" : "https://example.com" })
+    assert rv.data == b"https://localhost/E\n"
+    assert URL.query.count() == 1
+
+    rv = client.get("E")
+    assert rv.status_code == 302
+    assert rv.headers["Location"] == "https://example.com"
+
+class FakeResponse:
+    def __init__(self, data, headers):
+        self.raw = BytesIO(data)
+        self.headers = headers
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def test_store_url(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, "FHOST_FETCH_LOCK_PATH", str(tmp_path))
+    monkeypatch.setitem(app.config, "MAX_CONTENT_LENGTH", 1024)
+
+    responses = {
+        # no Content-Length, as with chunked transfer encoding
+        "https://example.com/chunked.txt" : FakeResponse(b"chunked", { "content-type" : "text/plain" }),
+        "https://example.com/large.bin" : FakeResponse(b"x" * 2048, {}),
+        "https://example.com/lies.bin" : FakeResponse(b"x" * 2048, { "content-length" : "10" }),
+    }
+    monkeypatch.setattr(fhost.fetch_session, "get", lambda url, **kwargs: responses[url])
+
+    rv = client.post("/", data={ "url" : "https://example.com/chunked.txt" })
+    assert rv.status_code == 200
+    assert File.query.get(1).getpath().read_bytes() == b"chunked"
+
+    for url in ("https://example.com/large.bin", "https://example.com/lies.bin"):
+        rv = client.post("/", data={ "url" : url })
+        assert rv.status_code == 413
+
+    # no temporary files are left behind
+    assert len(os.listdir(app.config["FHOST_STORAGE_PATH"])) == 1
+
+    # all slots taken
+    monkeypatch.setitem(app.config, "FHOST_FETCH_CONCURRENCY", 1)
+    with fhost.fetch_slot():
+        rv = client.post("/", data={ "url" : "https://example.com/chunked.txt" })
+        assert rv.status_code == 503
+
+def test_store_url_deadline(client, monkeypatch, tmp_path):
+    import socket
+    import threading
+
+    monkeypatch.setitem(app.config, "FHOST_FETCH_LOCK_PATH", str(tmp_path))
+    monkeypatch.setitem(app.config, "FHOST_FETCH_READ_TIMEOUT", 5)
+    monkeypatch.setitem(app.config, "FHOST_FETCH_DEADLINE", 1)
+
+    # An origin that sends one byte every 0.2 seconds, never staying silent
+    # long enough for the read timeout to trigger
+    server = socket.create_server(("127.0.0.1", 0))
+    stop = threading.Event()
+
+    def trickle():
+        conn, addr = server.accept()
+        with conn:
+            conn.recv(4096)
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n")
+            try:
+                while not stop.wait(0.2):
+                    conn.sendall(b"x")
+            except OSError:
+                pass
+
+    t = threading.Thread(target=trickle, daemon=True)
+    t.start()
+
+    start = time.monotonic()
+    rv = client.post("/", data={ "url" : f"http://127.0.0.1:{server.getsockname()[1]}/slow.bin" })
+    elapsed = time.monotonic() - start
+
+    stop.set()
+    server.close()
+
+    assert rv.status_code == 504
+    assert elapsed < 3
+
+def test_prune(client):
+    for i in range(3):
+        rv = client.post("/", buffered=True,
+                         content_type="multipart/form-data",
+                         data={ "file" : (BytesIO(b"prune me %d" % i), "prune.txt") })
+        assert rv.status_code == 200
+
+    for i in (1, 2):
+        f = File.query.get(i)
+        f.expiration = 1000
+    db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["prune", "--dry-run"])
+    assert result.exit_code == 0
+    assert "2 file(s) would be removed (20 bytes)" in result.output
+    assert all(File.query.get(i).getpath().is_file() for i in (1, 2, 3))
+
+    result = runner.invoke(args=["prune", "--batch-size", "1", "-j", "2"])
+    assert result.exit_code == 0
+    assert "2 file(s) removed" in result.output
+
+    for i in (1, 2):
+        f = File.query.get(i)
+        assert f.expiration is None
+        assert not f.getpath().is_file()
+
+    f = File.query.get(3)
+    assert f.expiration is not None
+    assert f.getpath().is_file()
+
+def test_prune_throttle(client, monkeypatch):
+    for i in range(4):
+        rv = client.post("/", buffered=True,
+                         content_type="multipart/form-data",
+                         data={ "file" : (BytesIO(b"prune me %d" % i), "prune.txt"),
+                                "expires" : "0" })
+        assert rv.status_code == 200
+
+    sleeps = []
+    monkeypatch.setattr(fhost.time, "sleep", sleeps.append)
+
+    # each removal waits its turn, not just the batch as a whole
+    result = app.test_cli_runner().invoke(args=["prune", "-j", "2", "--max-bytes", "100"])
+    assert result.exit_code == 0
+    assert "4 file(s) removed (40 bytes)" in result.output
+    assert len(sleeps) == 3
+    assert all(abs(a - b) < 0.05 for a, b in zip(sorted(sleeps), (0.1, 0.2, 0.3)))
+
+def test_prune_daemon(client, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_PRUNE_DAEMON", True)
+
+    # expires right away
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"short-lived"), "short.txt"),
+                            "expires" : "0" })
+    assert rv.status_code == 200
+
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"long-lived"), "long.txt") })
+    assert rv.status_code == 200
+
+    assert fhost.ExpiryEvent.query.count() == 1
+
+    class Stop(Exception):
+        pass
+
+    def sleep(t):
+        raise Stop()
+
+    monkeypatch.setattr(fhost.time, "sleep", sleep)
+    with pytest.raises(Stop):
+        fhost.prune_daemon(100, None)
+
+    f = File.query.get(1)
+    assert f.expiration is None
+    assert not f.getpath().is_file()
+    assert File.query.get(2).getpath().is_file()
+    assert fhost.ExpiryEvent.query.count() == 0
+
+    # without a daemon, nothing is queued for it
+    monkeypatch.setitem(app.config, "FHOST_PRUNE_DAEMON", False)
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"no daemon"), "short.txt"),
+                            "expires" : "0" })
+    assert rv.status_code == 200
+    assert fhost.ExpiryEvent.query.count() == 0
+
+    # and the timer-based prune clears leftovers
+    db.session.add(fhost.ExpiryEvent(2))
+    db.session.commit()
+    monkeypatch.undo()
+    result = app.test_cli_runner().invoke(args=["prune"])
+    assert result.exit_code == 0
+    assert fhost.ExpiryEvent.query.count() == 0
+
+def test_prune_daemon_idle(client, monkeypatch):
+    from sqlalchemy import event
+
+    loads = []
+    def count(conn, cursor, statement, *args):
+        if "ORDER BY file.expiration" in statement:
+            loads.append(statement)
+
+    resumable = []
+    monkeypatch.setattr(fhost, "prune_resumable", lambda: resumable.append(1))
+
+    class Stop(Exception):
+        pass
+
+    sleeps = []
+    def sleep(t):
+        sleeps.append(t)
+        if len(sleeps) == 5:
+            raise Stop()
+
+    monkeypatch.setattr(fhost.time, "sleep", sleep)
+
+    # with nothing to do, polling doesn't go through everything again
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        with pytest.raises(Stop):
+            fhost.prune_daemon(100, None)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+
+    assert sleeps == [app.config["FHOST_PRUNE_POLL_INTERVAL"]] * 5
+    assert len(loads) == 1
+    assert len(resumable) == 1
+
+def test_prune_daemon_events(client, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_PRUNE_DAEMON", True)
+
+    def upload(data):
+        rv = client.post("/", buffered=True,
+                         content_type="multipart/form-data",
+                         data={ "file" : (BytesIO(data), "short.txt"),
+                                "expires" : "0" })
+        assert rv.status_code == 200
+
+    class Stop(Exception):
+        pass
+
+    sleeps = []
+    def sleep(t):
+        sleeps.append(t)
+        if len(sleeps) == 2:
+            raise Stop()
+
+        # after the first event was handled, the next one gets its ID again
+        upload(b"second")
+        assert fhost.ExpiryEvent.query.one().id == 1
+
+    upload(b"first")
+    monkeypatch.setattr(fhost.time, "sleep", sleep)
+    with pytest.raises(Stop):
+        fhost.prune_daemon(100, None)
+
+    assert File.query.get(1).expiration is None
+    assert File.query.get(2).expiration is None
+
+class FakeClamd:
+    signatures = 26853
+
+    def version(self):
+        return f"ClamAV 1.0.1/{self.signatures}/Mon Mar 20 07:48:19 2023"
+
+    def instream(self, f):
+        if b"EVIL" in f.read():
+            return { "stream" : ("FOUND", "Fake.Virus") }
+        return { "stream" : ("OK", None) }
+
+    def scan(self, path):
+        with open(path, "rb") as f:
+            return { path : self.instream(f)["stream"] }
+
+def test_vscan(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, "VSCAN_SOCKET", FakeClamd())
+    monkeypatch.setitem(app.config, "VSCAN_QUARANTINE_PATH", str(tmp_path / "quarantine"))
+
+    for data in (b"good", b"EVIL", b"fine"):
+        rv = client.post("/", buffered=True,
+                         content_type="multipart/form-data",
+                         data={ "file" : (BytesIO(data), "scan.txt") })
+        assert rv.status_code == 200
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["vscan", "--limit", "2", "--batch-size", "1", "-j", "1"])
+    assert result.exit_code == 0
+    assert "2 file(s) scanned" in result.output
+
+    assert File.query.get(1).last_vscan is not None
+    assert File.query.get(2).removed
+    assert (tmp_path / "quarantine" / "Q.txt").is_file()
+    assert File.query.get(3).last_vscan is None
+
+    # picks up where it left off
+    result = runner.invoke(args=["vscan", "-j", "1"])
+    assert result.exit_code == 0
+    assert "1 file(s) scanned" in result.output
+    assert File.query.get(3).last_vscan is not None
+    assert not File.query.get(3).removed
+    assert File.query.get(3).vscan_signatures == 26853
+
+    # rescans only once the signatures have been updated
+    monkeypatch.setitem(app.config, "VSCAN_INTERVAL", datetime.timedelta(0))
+    result = runner.invoke(args=["vscan", "-j", "1"])
+    assert "0 file(s) scanned" in result.output
+
+    monkeypatch.setattr(FakeClamd, "signatures", 26854)
+    result = runner.invoke(args=["vscan", "-j", "1"])
+    assert "2 file(s) scanned" in result.output
+    assert File.query.get(1).vscan_signatures == 26854
+
+def test_vscan_priority(client, monkeypatch, tmp_path):
+    class FlakyClamd(FakeClamd):
+        def instream(self, f):
+            if b"broken" in f.read():
+                raise ConnectionError()
+            return { "stream" : ("OK", None) }
+
+    monkeypatch.setitem(app.config, "VSCAN_SOCKET", FlakyClamd())
+    monkeypatch.setitem(app.config, "VSCAN_QUARANTINE_PATH", str(tmp_path / "quarantine"))
+
+    for data, ctype in ((b"plain", "text/plain"), (b"broken", "text/plain"),
+                        (b"%PDF-1.4 doc", "application/pdf")):
+        rv = client.post("/", buffered=True,
+                         content_type="multipart/form-data",
+                         data={ "file" : (BytesIO(data), "f.bin", ctype) })
+        assert rv.status_code == 200
+
+    # risky types first
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["vscan", "--limit", "1", "-j", "1"])
+    assert "1 file(s) scanned" in result.output
+    assert File.query.get(3).last_vscan is not None
+    assert File.query.get(1).last_vscan is None
+
+    # failed scans are skipped for the rest of the run
+    result = runner.invoke(args=["vscan", "-j", "1", "--batch-size", "1"])
+    assert "SCAN FAILED" in result.output
+    assert "2 file(s) scanned" in result.output
+    assert File.query.get(1).last_vscan is not None
+    assert File.query.get(2).last_vscan is None
+
+def test_vscan_modes(client, monkeypatch, tmp_path):
+    import socket
+    import socketserver
+    import threading
+
+    class FildesHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            assert self.request.recv(8) == b"zFILDES\0"
+            msg, fds, flags, addr = socket.recv_fds(self.request, 1, 1)
+            with os.fdopen(fds[0], "rb") as f:
+                found = b"EVIL" in f.read()
+            self.request.sendall(b"fd[5]: Fake.Virus FOUND\0" if found else b"fd[5]: OK\0")
+
+    clamd = FakeClamd()
+    clamd.unix_socket = str(tmp_path / "clamd.sock")
+    server = socketserver.UnixStreamServer(clamd.unix_socket, FildesHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setitem(app.config, "VSCAN_SOCKET", clamd)
+    monkeypatch.setitem(app.config, "VSCAN_QUARANTINE_PATH", str(tmp_path / "quarantine"))
+    runner = app.test_cli_runner()
+
+    try:
+        for i, mode in enumerate(("scan", "fildes")):
+            monkeypatch.setitem(app.config, "VSCAN_MODE", mode)
+
+            for data in (b"good " + mode.encode(), b"EVIL " + mode.encode()):
+                rv = client.post("/", buffered=True,
+                                 content_type="multipart/form-data",
+                                 data={ "file" : (BytesIO(data), "scan.txt") })
+                assert rv.status_code == 200
+
+            result = runner.invoke(args=["vscan", "-j", "1"])
+            assert "2 file(s) scanned" in result.output
+            assert not File.query.get(i * 2 + 1).removed
+            assert File.query.get(i * 2 + 2).removed
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_upload_blocklist(client, monkeypatch, tmp_path):
+    from blocklist import IPBlocklist
+
+    blf = tmp_path / "blocklist"
+    blf.write_text("# comment\n192.0.2.0/24\n2001:db8::1\n::ffff:198.51.100.7\nbogus\n")
+    monkeypatch.setitem(app.config, "FHOST_UPLOAD_BLACKLIST", str(blf))
+
+    def upload(addr):
+        return client.post("/", buffered=True,
+                           content_type="multipart/form-data",
+                           environ_base={ "REMOTE_ADDR" : addr },
+                           data={ "file" : (BytesIO(addr.encode()), "bl.txt") })
+
+    assert upload("192.0.2.55").status_code == 451
+    assert upload("::ffff:192.0.2.1").status_code == 451
+    assert upload("2001:db8::ffff").status_code == 451
+    assert upload("198.51.100.7").status_code == 451
+    assert upload("192.0.3.1").status_code == 200
+    assert upload("2001:db8:0:1::1").status_code == 200
+
+    # appended entries are picked up without a full reload
+    bl = fhost.get_upload_blocklist()
+    bl.add("::ffff:203.0.113.9")
+    assert blf.read_text().endswith("\n203.0.113.9\n")
+    assert upload("203.0.113.9").status_code == 451
+    assert bl._offset == blf.stat().st_size
+
+    # other changes cause a rebuild
+    blf.write_text("10.0.0.0/8\n")
+    assert "192.0.2.55" not in bl
+    assert "10.1.2.3" in bl
+
+    exact = IPBlocklist(blf, v6_prefix=None)
+    exact.add("2001:db8::1")
+    assert "2001:db8::1" in exact
+    assert "2001:db8::2" not in exact
+
+    # the last line counts even without a trailing newline
+    blf.write_text("192.0.2.1\n198.51.100.7")
+    assert "198.51.100.7" in bl
+    assert "198.51.100.7" in IPBlocklist(blf)
+
+    # but is parsed again once it is completed
+    with open(blf, "a") as f:
+        f.write("0\n")
+    assert "198.51.100.70" in bl
+    assert "198.51.100.7" not in bl
+
+    blf.write_text("192.0.2.1\n198.51.100.7")
+    bl.add("203.0.113.9")
+    assert blf.read_text() == "192.0.2.1\n198.51.100.7\n203.0.113.9\n"
+    assert "198.51.100.7" in bl
+    assert "203.0.113.9" in bl
+
+def test_upload_ratelimit(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, "FHOST_RATELIMIT_PATH", str(tmp_path / "ratelimit.sqlite"))
+    monkeypatch.setitem(app.config, "FHOST_UPLOAD_RATE", 0.01)
+    monkeypatch.setitem(app.config, "FHOST_UPLOAD_BURST", 2)
+
+    def upload(addr, data):
+        return client.post("/", buffered=True,
+                           content_type="multipart/form-data",
+                           environ_base={ "REMOTE_ADDR" : addr },
+                           data={ "file" : (BytesIO(data), "rl.txt") })
+
+    assert upload("192.0.2.1", b"a").status_code == 200
+    assert upload("2001:db8::1", b"b").status_code == 200
+    assert upload("192.0.2.1", b"c").status_code == 200
+
+    rv = upload("192.0.2.1", b"d")
+    assert rv.status_code == 429
+    assert 0 < int(rv.headers["Retry-After"]) <= 101
+
+    # IPv6 clients are limited by their /64
+    assert upload("2001:db8::2", b"e").status_code == 200
+    assert upload("2001:db8::3", b"f").status_code == 429
+    assert upload("2001:db8:1::1", b"g").status_code == 200
+
+    monkeypatch.setitem(app.config, "FHOST_UPLOAD_RATE", None)
+    monkeypatch.setitem(app.config, "FHOST_UPLOAD_INFLIGHT_BYTES", 1024)
+
+    limiter = fhost.get_ratelimiter()
+    rid = limiter.reserve(1000, 1024)
+
+    rv = upload("192.0.2.1", b"h")
+    assert rv.status_code == 503
+    assert "Retry-After" in rv.headers
+
+    limiter.release(rid)
+    assert upload("192.0.2.1", b"i").status_code == 200
+    assert limiter.reserve(1024, 1024) is not None
+
+def test_concurrent_upload(client):
+    import threading
+    from hashlib import sha256
+
+    data = b"viral content"
+    digest = sha256(data).hexdigest()
+    storage = Path(app.config["FHOST_STORAGE_PATH"])
+    results = []
+
+    def upload():
+        with app.test_client() as c:
+            rv = c.post("/", buffered=True,
+                        content_type="multipart/form-data",
+                        data={ "file" : (BytesIO(data), "viral.txt") })
+            results.append((rv.status_code, rv.headers.get("X-Token")))
+
+    storage.mkdir(parents=True, exist_ok=True)
+    with fhost.digest_lock(storage, digest):
+        threads = [threading.Thread(target=upload) for i in range(2)]
+        for t in threads:
+            t.start()
+
+        time.sleep(0.5)
+        assert not results
+
+    for t in threads:
+        t.join()
+
+    # one of them stored the file, the other reused it
+    assert sorted(r[0] for r in results) == [200, 200]
+    assert len([r for r in results if r[1]]) == 1
+    assert File.query.filter_by(sha256=digest).count() == 1
+    assert os.listdir(storage) == [digest]
+
+def test_store_hash(client):
+    from hashlib import sha256
+
+    data = b"build artifact"
+    digest = sha256(data).hexdigest()
+
+    def offer(digest, size, **kwargs):
+        return client.post("/", data={ "sha256" : digest, "size" : size, **kwargs })
+
+    assert offer(digest, len(data)).status_code == 404
+    assert offer("nothex", len(data)).status_code == 400
+
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(data), "artifact.bin") })
+    assert rv.status_code == 200
+    url = rv.get_data(as_text=True)
+
+    rv = offer(digest.upper(), len(data), expires="1")
+    assert rv.status_code == 200
+    assert rv.get_data(as_text=True) == url
+    assert "X-Token" not in rv.headers
+    assert offer(digest, len(data) + 1).status_code == 404
+
+    # expired files are renewed with a new token
+    f = File.query.filter_by(sha256=digest).first()
+    f.expiration = None
+    token = f.mgmt_token
+    db.session.commit()
+    rv = offer(digest, len(data))
+    assert rv.status_code == 200
+    assert rv.headers["X-Token"] not in (None, token)
+    assert File.query.filter_by(sha256=digest).first().expiration is not None
+
+    # secret URLs aren't handed out for just the digest
+    rv = client.post("/", buffered=True,
+                     content_type="multipart/form-data",
+                     data={ "file" : (BytesIO(b"secret artifact"), "s.bin"), "secret" : "" })
+    assert rv.status_code == 200
+    assert offer(sha256(b"secret artifact").hexdigest(), 15).status_code == 404
+
+    f = File.query.filter_by(sha256=digest).first()
+    f.removed = True
+    db.session.commit()
+    assert offer(digest, len(data)).status_code == 451
+
+def test_resumable_upload(client, monkeypatch):
+    from hashlib import sha256
+
+    data = os.urandom(100000)
+
+    rv = client.post("/", data={ "resumable" : len(data), "filename" : "big.bin" })
+    assert rv.status_code == 201
+    url = rv.headers["Location"]
+    path = url.replace("http://localhost", "")
+
+    rv = client.patch(path, data=data[:40000], headers={ "Upload-Offset" : "0" })
+    assert rv.status_code == 204
+    assert rv.headers["Upload-Offset"] == "40000"
+
+    # a retried part is rejected with the current offset
+    rv = client.patch(path, data=data[:40000], headers={ "Upload-Offset" : "0" })
+    assert rv.status_code == 409
+    assert rv.headers["Upload-Offset"] == "40000"
+
+    rv = client.head(path)
+    assert rv.headers["Upload-Offset"] == "40000"
+    assert rv.headers["Upload-Length"] == str(len(data))
+
+    assert client.patch(path, data=data[40000:] + b"x",
+                        headers={ "Upload-Offset" : "40000" }).status_code == 413
+
+    rv = client.patch(path, data=data[40000:], headers={ "Upload-Offset" : "40000" })
+    assert rv.status_code == 200
+    assert "X-Token" in rv.headers
+    assert client.head(path).status_code == 404
+
+    f = File.query.filter_by(sha256=sha256(data).hexdigest()).first()
+    assert f.size == len(data)
+    assert f.ext == ".bin"
+    assert f.getpath().read_bytes() == data
+
+    rv = client.get(rv.get_data(as_text=True).strip().replace("http://localhost", ""))
+    assert rv.status_code == 200
+
+    # abandoned uploads are removed by prune
+    rv = client.post("/", data={ "resumable" : 10 })
+    token = rv.headers["Location"].rsplit("/", 1)[1]
+    staging = fhost.UploadSession.query.get(token).getpath()
+    assert staging.is_file()
+
+    # as are staging and spool files left behind by crashes
+    storage = Path(app.config["FHOST_STORAGE_PATH"])
+    orphans = [storage / ".resumable-gone", storage / ".upload-crashed"]
+    for p in orphans:
+        p.write_bytes(b"partial")
+        os.utime(p, (time.time() - 3600, time.time() - 3600))
+
+    # but not the staging files of uploads still in progress
+    rv = client.post("/", data={ "resumable" : 10 })
+    active = fhost.UploadSession.query.get(rv.headers["Location"].rsplit("/", 1)[1])
+    os.utime(active.getpath(), (time.time() - 3600, time.time() - 3600))
+
+    monkeypatch.setitem(app.config, "FHOST_RESUMABLE_TTL", datetime.timedelta(minutes=1))
+    fhost.UploadSession.query.get(token).updated = datetime.datetime.now() - datetime.timedelta(hours=1)
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["prune"])
+    assert result.exit_code == 0
+    assert fhost.UploadSession.query.get(token) is None
+    assert not staging.exists()
+    assert not any(p.exists() for p in orphans)
+    assert active.getpath().is_file()
+
+    # without a way to save the hash state, the file is hashed at the end
+    monkeypatch.setattr(fhost.SHA256State, "available", False)
+    data = b"resumed without hash state"
+    path = client.post("/", data={ "resumable" : len(data) }).headers["Location"].replace("http://localhost", "")
+    client.patch(path, data=data[:10], headers={ "Upload-Offset" : "0" })
+    rv = client.patch(path, data=data[10:], headers={ "Upload-Offset" : "10" })
+    assert rv.status_code == 200
+    assert File.query.filter_by(sha256=sha256(data).hexdigest()).first().size == len(data)
+
+def fake_nsfw_worker_init():
+    pass
+
+def fake_nsfw_detect(f):
+    data = f["path"].read_bytes()
+
+    if b"crash" in data:
+        raise RuntimeError("classifier crashed")
+
+    f["score"] = -1.0 if b"broken" in data else 0.9 if b"nsfw" in data else 0.1
+    return f
+
+def upload_unscored(client, files):
+    for data, ctype in files:
+        rv = client.post("/", buffered=True,
+                         content_type="multipart/form-data",
+                         data={ "file" : (BytesIO(data), "n.bin", ctype) })
+        assert rv.status_code == 200
+
+def test_nsfw_worker(client, monkeypatch):
+    monkeypatch.setitem(app.config, "NSFW_DETECT", True)
+    monkeypatch.setitem(app.config, "NSFW_ASYNC", True)
+    monkeypatch.setitem(app.config, "NSFW_RETRIES", 2)
+    monkeypatch.setitem(app.config, "NSFW_RETRY_DELAY", 0)
+    monkeypatch.setattr(fhost, "nsfw_worker_init", fake_nsfw_worker_init)
+    monkeypatch.setattr(fhost, "do_nsfw_detect", fake_nsfw_detect)
+
+    upload_unscored(client, [(b"nsfw image", "image/png"),
+                             (b"broken image", "image/png"),
+                             (b"broken text", "text/plain")])
+    assert File.query.filter(File.nsfw_score != None).count() == 0
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["nsfw-worker", "--once", "-j", "1"])
+    assert result.exit_code == 0
+
+    # media files are retried before giving up, anything else isn't
+    assert "retry 1 of 2" in result.output
+    assert "retry 2 of 2" in result.output
+    assert "giving up" in result.output
+    assert result.output.count("scoring failed") == 3
+    assert [File.query.get(i).nsfw_score for i in (1, 2, 3)] == [0.9, -1, -1]
+
+    # files waiting for a retry are left for later
+    monkeypatch.setitem(app.config, "NSFW_RETRY_DELAY", 3600)
+    upload_unscored(client, [(b"broken again", "video/mp4")])
+
+    result = runner.invoke(args=["nsfw-worker", "--once", "-j", "1"])
+    assert result.exit_code == 0
+    assert "retry 1 of 2" in result.output
+    assert File.query.get(4).nsfw_score is None
+
+    # newer files are scored first
+    monkeypatch.setitem(app.config, "NSFW_RETRY_DELAY", 0)
+    File.query.get(4).getpath().write_bytes(b"crash video")
+    upload_unscored(client, [(b"image %d" % i, "image/png") for i in range(4)])
+
+    result = runner.invoke(args=["nsfw-worker", "--once", "-j", "1"])
+    assert result.exit_code != 0
+    assert [File.query.get(i).nsfw_score for i in range(5, 9)] == [0.1] * 4
+    assert File.query.get(4).nsfw_score is None
+
+def test_nsfwscan(client, monkeypatch):
+    monkeypatch.setitem(app.config, "NSFW_DETECT", True)
+    monkeypatch.setitem(app.config, "NSFW_ASYNC", True)
+    monkeypatch.setattr(fhost, "nsfw_worker_init", fake_nsfw_worker_init)
+    monkeypatch.setattr(fhost, "do_nsfw_detect", fake_nsfw_detect)
+
+    upload_unscored(client, [(b"nsfw image", "image/png"),
+                             (b"crash image", "image/png"),
+                             (b"broken image", "image/png")])
+
+    # interrupted after the first batch
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["nsfwscan", "-j", "1", "--batch-size", "1"])
+    assert result.exit_code != 0
+    assert File.query.get(1).nsfw_score == 0.9
+    assert File.query.get(2).nsfw_score is None
+
+    # picks up where it left off
+    path = File.query.get(2).getpath()
+    path.write_bytes(b"clean image")
+    result = runner.invoke(args=["nsfwscan", "-j", "1", "--batch-size", "1"])
+    assert result.exit_code == 0
+    assert "Done!  2 file(s) scored" in result.output
+    assert "scoring failed" in result.output
+    assert File.query.get(2).nsfw_score == 0.1
+    assert File.query.get(3).nsfw_score == -1
+
+    # failed files are only scored again with --failed
+    result = runner.invoke(args=["nsfwscan", "-j", "1"])
+    assert "Done!  0 file(s) scored" in result.output
+
+    File.query.get(3).getpath().write_bytes(b"nsfw image, now readable")
+    result = runner.invoke(args=["nsfwscan", "-j", "1", "--failed"])
+    assert "Done!  1 file(s) scored" in result.output
+    assert File.query.get(3).nsfw_score == 0.9